@@ -0,0 +1,93 @@
+"""
+Single-pass character-class profiling of blobs.
+
+Every byte value maps to a bitmask of the alphabets it can be part of. From a
+histogram of a blob, which takes one pass over it, we then know for all
+alphabets at once whether the whole blob fits in them.
+"""
+
+from collections import Counter, namedtuple
+from functools import reduce
+import operator
+
+import base58
+
+BINARY = 1 << 0
+OCTAL = 1 << 1
+HEX = 1 << 2
+BASE32 = 1 << 3
+BASE58 = 1 << 4
+BASE64 = 1 << 5
+ASCII85 = 1 << 6
+NORMAL = 1 << 7  # Printable ASCII and a few common control characters
+
+ALL = (1 << 8) - 1
+
+# Alphabets in which whitespace is ignored
+WHITESPACE_INSENSITIVE = BINARY | OCTAL | HEX | BASE32 | BASE58 | BASE64
+
+_ALPHABETS = {
+    BINARY: b'01',
+    OCTAL: b'01234567',
+    HEX: b'0123456789abcdefABCDEF',
+    BASE32: b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567=',
+    BASE58: base58.BITCOIN_ALPHABET.encode(),
+    BASE64: b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=',
+    ASCII85: bytes(range(ord('!'), ord('u') + 1)) + b'~',
+    NORMAL: bytes(range(ord(' '), ord('~') + 1)) + b'\x00\x04\n\r',
+}
+WHITESPACE = b' \t\n\r\x0b\x0c'
+
+
+def _build_class_table():
+    table = [0] * 256
+    for alphabet, members in _ALPHABETS.items():
+        for value in members:
+            table[value] |= alphabet
+    for value in WHITESPACE:
+        table[value] |= WHITESPACE_INSENSITIVE
+    return table
+
+
+# Byte value -> bitmask of alphabets it's in
+CLASS_TABLE = _build_class_table()
+
+# From this size on, NumPy's bincount beats Counter (and its import time)
+NUMPY_THRESHOLD = 1 << 16
+
+
+class Profile(namedtuple('Profile',
+                         'length n_unique min max histogram classes')):
+    """
+    Summary of a blob: its length, the number of distinct byte values, the
+    smallest and largest one, the count of every byte value, and the bitmask
+    of alphabets all of its bytes are in.
+    """
+
+    def is_in(self, alphabet):
+        return self.classes & alphabet == alphabet
+
+    def count(self, char):
+        return self.histogram[ord(char)]
+
+
+def profile(data):
+    """Profile a bytes-like object in a single pass over it."""
+    if len(data) >= NUMPY_THRESHOLD:
+        import numpy as np
+        histogram = np.bincount(np.frombuffer(data, np.uint8),
+                                minlength=256).tolist()
+    else:
+        counts = Counter(data)
+        histogram = [counts[value] for value in range(256)]
+
+    present = [value for value, count in enumerate(histogram) if count > 0]
+    classes = reduce(operator.and_, (CLASS_TABLE[v] for v in present), ALL)
+    return Profile(
+        length=len(data),
+        n_unique=len(present),
+        min=present[0] if present else None,
+        max=present[-1] if present else None,
+        histogram=histogram,
+        classes=classes,
+    )
@@ -1,20 +1,121 @@
+from functools import lru_cache
+import math
+import operator
+
+import budget
+import tracing
+
 BITCOIN_ALPHABET = \
     '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 RIPPLE_ALPHABET = 'rpshnaf39wBUDNEGHJKLM4PQRST7VWXYZ2bcdeCg65jkm8oFqi1tuvAxyz'
+FLICKR_ALPHABET = \
+    '123456789abcdefghijkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ'
+
+ALPHABETS = {
+    'BTC': BITCOIN_ALPHABET,
+    'RIPPLE': RIPPLE_ALPHABET,
+    'FLICKR': FLICKR_ALPHABET,
+}
+
+# Number of digits to convert to an int at once with NumPy: 58 ** 10 < 2 ** 64
+CHUNK_SIZE = 10
+
+# Size in bits from which multiplying ints with an FFT beats Python's own
+# (Karatsuba) multiplication, and the size in bytes of a product up to which
+# the FFT's floating-point error stays far enough below 1/2 to round it away
+FFT_MIN_BITS = 1 << 15
+FFT_MAX_BYTES = 1 << 22
 
 
 def decode(s, alphabet='BTC'):
-    alphabet = {'BTC': BITCOIN_ALPHABET, 'RIPPLE': RIPPLE_ALPHABET}[alphabet]
-    acc = decode_as_int(s, alphabet)
-    result = []
-    while acc > 0:
-        acc, mod = divmod(acc, 256)
-        result.append(mod)
-    return bytes(reversed(result))
+    digits = decode_as_digits(s, ALPHABETS[alphabet])
+    budget.check_size(math.ceil(len(digits) * math.log(58, 256)))
+    # Every leading zero digit stands for a leading zero byte
+    n_zeros = len(digits) - len(digits.lstrip(b'\x00'))
+    with tracing.step('base58.digits_to_int', len(digits)):
+        acc = digits_to_int(digits)
+    return bytes(n_zeros) + acc.to_bytes((acc.bit_length() + 7) // 8, 'big')
 
 
 def decode_as_int(s, alphabet):
-    decimal = 0
-    for char in s:
-        decimal = decimal * 58 + alphabet.index(char)
-    return decimal
+    return digits_to_int(decode_as_digits(s, alphabet))
+
+
+def decode_as_digits(s, alphabet):
+    """Map every character of s to its digit value, in one pass."""
+    encoded = s.encode('ascii')
+    alphabet = alphabet.encode('ascii')
+    if len(encoded.translate(None, alphabet)) > 0:
+        raise ValueError('Invalid base58 character')
+    return encoded.translate(_translation_table(alphabet))
+
+
+def digits_to_int(digits):
+    """
+    Convert base58 digits to an int by combining ever bigger groups of them in
+    pairs, so the work is dominated by a few big multiplications instead of
+    one per digit.
+    """
+    import numpy as np
+
+    # The value of every CHUNK_SIZE digits, counting from the end
+    n_chunks = -(-len(digits) // CHUNK_SIZE)
+    padded = np.zeros(n_chunks * CHUNK_SIZE, np.uint64)
+    padded[len(padded) - len(digits):] = np.frombuffer(digits, np.uint8)
+    weights = np.uint64(58) ** np.arange(CHUNK_SIZE - 1, -1, -1,
+                                         dtype=np.uint64)
+    groups = (padded.reshape(n_chunks, CHUNK_SIZE) @ weights).tolist()
+
+    n_digits = CHUNK_SIZE
+    while len(groups) > 1:
+        budget.checkpoint()
+        # Pair up the groups from the end, so that every low group has
+        # n_digits digits. A group left over at the front stays as it is.
+        power = _power(n_digits)
+        times = (multiply if power.bit_length() >= FFT_MIN_BITS
+                 else operator.mul)
+        odd = len(groups) % 2
+        groups[odd:] = [times(high, power) + low
+                        for high, low in zip(groups[odd::2],
+                                             groups[odd + 1::2])]
+        n_digits *= 2
+    return groups[0] if groups else 0
+
+
+def multiply(a, b):
+    """
+    Multiply two non-negative ints, as the convolution of their bytes with an
+    FFT if they are big enough, which takes O(n log n) instead of O(n^1.58).
+    """
+    import numpy as np
+
+    n_a = (a.bit_length() + 7) // 8
+    n_b = (b.bit_length() + 7) // 8
+    n = n_a + n_b - 1
+    if min(a.bit_length(), b.bit_length()) < FFT_MIN_BITS \
+            or n > FFT_MAX_BYTES:
+        return a * b
+
+    size = 1 << (n - 1).bit_length()
+    x = np.fft.rfft(np.frombuffer(a.to_bytes(n_a, 'little'), np.uint8), size)
+    y = np.fft.rfft(np.frombuffer(b.to_bytes(n_b, 'little'), np.uint8), size)
+    sums = np.rint(np.fft.irfft(x * y, size)[:n]).astype('<u8')
+    # Every sum of byte products is worth its place, and fits in 8 bytes:
+    # add the bytes of all of them, one byte of each at a time
+    sum_bytes = sums.view(np.uint8).reshape(n, 8)
+    return sum(int.from_bytes(sum_bytes[:, k].tobytes(), 'little') << 8 * k
+               for k in range(8))
+
+
+@lru_cache(maxsize=None)
+def _translation_table(alphabet):
+    return bytes.maketrans(alphabet, bytes(range(len(alphabet))))
+
+
+@lru_cache(maxsize=32)
+def _power(n):
+    # n is CHUNK_SIZE times a power of two: square the power for half of it
+    if n <= CHUNK_SIZE:
+        return 58 ** n
+    half = _power(n // 2)
+    return multiply(half, half)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Run the decoders over a whole corpus of files in one interpreter.
+
+Files are taken from the given directories (recursively) and files, or read
+one path per line from stdin for `-`. They're decoded in a pool of worker
+processes, and every finding is written to stdout as a line of JSON as soon as
+its file is done, e.g.
+
+    {"file": "a.png", "chain": ["png", "text"], "depth": 2, ...}
+
+where chain lists the decoders that led to the finding, named as registered
+(see decoders.register).
+"""
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import contextlib
+import json
+import os
+import sys
+
+import budget
+import detect
+import image
+
+# Decoding untrusted files is limited by default
+DEFAULT_BUDGET = budget.Budget(seconds=300, depth=16, nodes=10_000,
+                               decoder_seconds=30, blob_size=1 << 28)
+
+
+def iter_paths(paths):
+    for path in paths:
+        if path == '-':
+            yield from iter_paths(line.rstrip('\n') for line in sys.stdin
+                                  if line.strip())
+        elif os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+
+def scan_file(path, limits=DEFAULT_BUDGET):
+    """Decode a single file, returning its findings as JSON-able records."""
+    records = []
+
+    def on_finding(data, chain, score):
+        records.append({
+            'file': path,
+            'chain': list(chain),
+            'depth': len(chain),
+            'digest': detect.digest(data).hex(),
+            'length': len(data),
+            'score': round(score, 3),
+            'preview': detect.pprint_data(data),
+        })
+
+    def on_truncation(truncation):
+        records.append({
+            'file': path,
+            'truncated': truncation.reason,
+            'chain': list(truncation.chain),
+            'detail': truncation.detail,
+        })
+
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        try:
+            with detect.open_input(path) as data:
+                detect.keep_decoding(data, on_finding=on_finding,
+                                     limits=limits,
+                                     on_truncation=on_truncation)
+        except Exception as e:
+            records.append({
+                'file': path,
+                'error': f'{type(e).__name__}: {e}',
+            })
+    return records
+
+
+def scan(paths, jobs, window, visuals='skip', output_dir='.',
+         limits=DEFAULT_BUDGET, decode_frames=0):
+    """Yield the records of all files, in the order the files finish."""
+    with ProcessPoolExecutor(
+            jobs, initializer=image.configure,
+            initargs=(visuals, output_dir, decode_frames)) as pool:
+        paths = iter(paths)
+        in_flight = set()
+        while True:
+            for path in paths:
+                in_flight.add(pool.submit(scan_file, path, limits))
+                if len(in_flight) >= window:
+                    break
+            if len(in_flight) == 0:
+                return
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Find hidden messages in a corpus of files.'
+    )
+    parser.add_argument(
+        'paths', nargs='+',
+        help='files or directories to scan (-: read paths from stdin)',
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=0,
+        help='number of worker processes (default: one per CPU)',
+    )
+    parser.add_argument(
+        '--window', type=int,
+        help='maximum number of files being decoded at once'
+             ' (default: four times the number of jobs)',
+    )
+    parser.add_argument(
+        '--visuals', choices=('save', 'skip'), default='skip',
+        help='whether to save images and histograms to files'
+             ' (default: skip)',
+    )
+    parser.add_argument(
+        '--output-dir', default='.',
+        help='directory to save images and histograms to (default: .)',
+    )
+    parser.add_argument(
+        '--decode-frames', type=int, default=0,
+        help='number of frames of an animated GIF to decode the image data'
+             ' of, to look for data hidden in it (default: 0, all of them)',
+    )
+    budget.add_arguments(parser, DEFAULT_BUDGET)
+    args = parser.parse_args(argv)
+
+    jobs = args.jobs or os.cpu_count()
+    records = scan(iter_paths(args.paths), jobs, args.window or 4 * jobs,
+                   args.visuals, args.output_dir,
+                   budget.from_arguments(args), args.decode_frames)
+    for record in records:
+        print(json.dumps(record), flush=True)
+
+
+if __name__ == "__main__":
+    main()
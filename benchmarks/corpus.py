@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+Generate a deterministic corpus of inputs for the decoder benchmarks, together
+with a manifest.json that lists the benchmark cases on it.
+
+    benchmarks/corpus.py [--scale small|large] [--output-dir DIR]
+
+The same scale and seed always give the same corpus (for the same versions of
+NumPy and Pillow), so results of different runs can be compared.
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import base58  # noqa: E402
+import morse  # noqa: E402
+
+DEFAULT_OUTPUT_DIR = os.path.join(REPO, 'benchmarks', 'corpus')
+MESSAGE = b'flag{the quick brown fox jumps over the lazy dog}'
+
+# Sizes per scale: image sides in pixels, numbers of animation frames, sizes
+# in bytes of the text before encoding, and depths of encoding chains
+SCALES = {
+    'small': {
+        'image_sides': (64, 512, 2048),
+        'frames': (10, 100),
+        'text_sizes': (1 << 10, 1 << 16, 1 << 20),
+        'morse_sizes': (1 << 10, 1 << 14),
+        'base58_sizes': (1 << 10, 1 << 14),
+        'chain_depths': (1, 4, 8),
+    },
+    'large': {
+        'image_sides': (64, 512, 2048, 8192, 12288),
+        'frames': (10, 100, 1000, 4000),
+        'text_sizes': (1 << 10, 1 << 16, 1 << 20, 1 << 24, 1 << 27),
+        'morse_sizes': (1 << 10, 1 << 14, 1 << 18, 1 << 22),
+        'base58_sizes': (1 << 10, 1 << 14, 1 << 17),
+        'chain_depths': (1, 4, 8, 12, 16),
+    },
+}
+
+ENCODINGS = ('base64', 'base32', 'base58', 'hex')
+
+
+def generate(output_dir, scale='small', seed=0):
+    """Write the corpus to output_dir and return its benchmark cases."""
+    import numpy as np
+
+    sizes = SCALES[scale]
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    cases = []
+
+    def add(name, module, content):
+        with open(os.path.join(output_dir, name), 'wb') as f:
+            f.write(content)
+        cases.append({'name': name, 'module': module, 'size': len(content)})
+
+    for side in sizes['image_sides']:
+        pixels = noisy_gradient(rng, side, side)
+        add(f'lsb-{side}.png', 'png', save_image(pixels, 'PNG'))
+        add(f'photo-{side}.jpeg', 'jpeg',
+            save_image(pixels, 'JPEG', quality=90))
+        add(f'still-{side}.gif', 'gif',
+            save_image(pixels, 'GIF', comment=base64.b64encode(MESSAGE)))
+    for n_frames in sizes['frames']:
+        add(f'animated-{n_frames}.gif', 'gif', animated_gif(rng, n_frames))
+
+    for size in sizes['text_sizes']:
+        add(f'text-{size}.b64', 'text', base64.b64encode(padded(size)))
+    for size in sizes['morse_sizes']:
+        add(f'morse-{size}.txt', 'morse',
+            morse_bits(padded_text(size)).encode('ascii'))
+    for size in sizes['base58_sizes']:
+        digits = rng.integers(0, 58, size, dtype=np.uint8)
+        alphabet = base58.BITCOIN_ALPHABET.encode('ascii')
+        add(f'base58-{size}.txt', 'base58',
+            bytes(alphabet[digit] for digit in digits))
+    for depth in sizes['chain_depths']:
+        add(f'chain-{depth}.txt', 'text', encode_chain(MESSAGE, depth))
+
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump({'scale': scale, 'seed': seed, 'cases': cases}, f, indent=2)
+    return cases
+
+
+def noisy_gradient(rng, width, height):
+    """An RGB image with some structure, with MESSAGE in the red LSBs."""
+    import numpy as np
+
+    y, x = np.mgrid[0:height, 0:width]
+    gradient = np.stack([x * 255 // max(width - 1, 1),
+                         y * 255 // max(height - 1, 1),
+                         (x + y) * 255 // max(width + height - 2, 1)], axis=2)
+    noise = rng.integers(-8, 9, gradient.shape)
+    pixels = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+
+    bits = np.unpackbits(np.frombuffer(MESSAGE, np.uint8))[:width * height]
+    red = pixels[:, :, 0].reshape(-1)
+    red[:len(bits)] = (red[:len(bits)] & 0xfe) | bits
+    return pixels
+
+
+def save_image(pixels, format, **params):
+    import io
+
+    import PIL.Image
+
+    image = PIL.Image.fromarray(pixels)
+    if format == 'GIF':
+        image = image.quantize(256)
+    if format == 'PNG':
+        # Noise doesn't compress anyway; don't spend time trying
+        params['compress_level'] = 1
+    output = io.BytesIO()
+    image.save(output, format, **params)
+    return output.getvalue()
+
+
+def animated_gif(rng, n_frames, side=32):
+    """An animation with its own palette per frame."""
+    import io
+
+    import numpy as np
+    import PIL.Image
+
+    frames = []
+    for _ in range(n_frames):
+        frame = PIL.Image.fromarray(
+            rng.integers(0, 256, (side, side), dtype=np.uint8), 'P')
+        frame.putpalette(rng.integers(0, 256, 768, dtype=np.uint8).tobytes())
+        frames.append(frame)
+    output = io.BytesIO()
+    frames[0].save(output, 'GIF', save_all=True, append_images=frames[1:],
+                   duration=20, loop=0, optimize=False)
+    return output.getvalue()
+
+
+def padded(size):
+    """MESSAGE, followed by English-looking filler up to size bytes."""
+    return padded_text(size).encode('ascii')
+
+
+def padded_text(size):
+    text = MESSAGE.decode('ascii') + ' '
+    filler = 'the quick brown fox jumps over the lazy dog '
+    return (text + filler * (size // len(filler) + 1))[:size]
+
+
+def morse_bits(text, unit=3):
+    """Encode text as a string of morse code bits, `unit` bits per unit."""
+    codes = {letter: code for code, letter in morse.ALPHABET.items()}
+    dot, dash = '1' * unit, '1' * 3 * unit
+    symbol_gap, letter_gap, word_gap = ('0' * n * unit for n in (1, 3, 7))
+    words = []
+    for word in text.lower().split():
+        letters = [symbol_gap.join(dot if symbol == '.' else dash
+                                   for symbol in codes[letter])
+                   for letter in word if letter in codes]
+        words.append(letter_gap.join(letters))
+    return word_gap.join(words)
+
+
+def encode_chain(data, depth):
+    """Encode data with `depth` encodings in a row, cycling through them."""
+    for i in range(depth):
+        match ENCODINGS[i % len(ENCODINGS)]:
+            case 'base64':
+                data = base64.b64encode(data)
+            case 'base32':
+                data = base64.b32encode(data)
+            case 'base58':
+                data = base58_encode(data)
+            case 'hex':
+                data = data.hex().encode('ascii')
+    return data
+
+
+def base58_encode(data, chunk_digits=16):
+    """Encode data in base58, taking off several digits per big division."""
+    alphabet = base58.BITCOIN_ALPHABET
+    n_zeros = len(data) - len(data.lstrip(b'\x00'))
+    acc = int.from_bytes(data, 'big')
+    digits = []
+    while acc > 0:
+        acc, chunk = divmod(acc, 58 ** chunk_digits)
+        for _ in range(chunk_digits):
+            chunk, digit = divmod(chunk, 58)
+            digits.append(alphabet[digit])
+    encoded = ''.join(reversed(digits)).lstrip(alphabet[0])
+    return (alphabet[0] * n_zeros + encoded).encode('ascii')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR)
+    args = parser.parse_args(argv)
+
+    cases = generate(args.output_dir, args.scale, args.seed)
+    total = sum(case['size'] for case in cases)
+    print(f'Generated {len(cases)} files ({total / 1e6:.1f} MB)'
+          f' in {args.output_dir}')
+
+
+if __name__ == "__main__":
+    main()
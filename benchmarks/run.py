@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Benchmark every decoder module on a corpus made by benchmarks/corpus.py.
+
+    benchmarks/run.py [--corpus DIR] [--module png] [--output results.json]
+                      [--compare baseline.json [--tolerance 0.25]]
+
+Every case runs in a fresh interpreter, which reports how long importing the
+module took, how long decoding took the first time (including lazy imports)
+and at the median of the following runs, the throughput, and the peak memory
+use. Results are printed as JSON lines as they come in, and can be written to
+one JSON file together with the environment they were measured in.
+
+With --compare, the results are checked against an earlier results file, and
+the run fails if any case got slower, or uses more memory, by more than the
+tolerance.
+"""
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CORPUS = os.path.join(REPO, 'benchmarks', 'corpus')
+
+# Metrics that are compared against a baseline; lower is better for all
+COMPARED_METRICS = ('median_s', 'peak_rss_mb')
+
+
+def decode_image(module, data):
+    import image
+
+    image.configure('skip')
+    return list(module.try_decode(data, None))
+
+
+def decode_search(module, data):
+    import detect
+
+    return detect.keep_decoding(data)
+
+
+def decode_base58(module, data):
+    return module.decode(data.decode('ascii'))
+
+
+def decode_morse(module, data):
+    return list(module.try_decode(data.decode('ascii')))
+
+
+# What to run for the cases of each module
+DECODE = {
+    'png': decode_image,
+    'gif': decode_image,
+    'jpeg': decode_image,
+    'text': decode_search,
+    'base58': decode_base58,
+    'morse': decode_morse,
+}
+
+
+def run_case(corpus, case, runs):
+    """Run one case in this interpreter and return its measurements."""
+    import resource
+
+    sys.path.insert(0, REPO)
+    start = time.perf_counter()
+    module = importlib.import_module(case['module'])
+    import_s = time.perf_counter() - start
+
+    with open(os.path.join(corpus, case['name']), 'rb') as f:
+        data = f.read()
+    timings = []
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for _ in range(runs):
+            start = time.perf_counter()
+            DECODE[case['module']](module, data)
+            timings.append(time.perf_counter() - start)
+
+    # The first run includes the lazy imports of the module
+    median_s = statistics.median(timings[1:] or timings)
+    return {
+        **case,
+        'runs': runs,
+        'import_ms': 1000 * import_s,
+        'first_s': timings[0],
+        'median_s': median_s,
+        'throughput_mb_s': case['size'] / 1e6 / median_s,
+        # Kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / 1024,
+    }
+
+
+def run_in_subprocess(corpus, case, runs, timeout):
+    command = [sys.executable, os.path.abspath(__file__), '--corpus', corpus,
+               '--runs', str(runs), '--in-process', json.dumps(case)]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True,
+                                timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {**case, 'error': f'timed out after {timeout}s'}
+    if result.returncode != 0:
+        return {**case, 'error': result.stderr.strip().splitlines()[-1]}
+    return json.loads(result.stdout)
+
+
+def environment(corpus):
+    from importlib import metadata
+
+    def version(package):
+        try:
+            return metadata.version(package)
+        except metadata.PackageNotFoundError:
+            return None
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO,
+                                capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    with open(os.path.join(corpus, 'manifest.json')) as f:
+        manifest = json.load(f)
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': version('numpy'),
+        'pillow': version('pillow'),
+        'corpus_scale': manifest['scale'],
+        'corpus_seed': manifest['seed'],
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a description of every regression against the baseline."""
+    baseline = {result['name']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = baseline.get(result['name'])
+        if before is None or 'error' in result or 'error' in before:
+            continue
+        for metric in COMPARED_METRICS:
+            ratio = result[metric] / before[metric]
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    f'{result["name"]}: {metric} {before[metric]:.3g}'
+                    f' -> {result[metric]:.3g} ({ratio - 1:+.0%})'
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS,
+                        help='corpus directory (see benchmarks/corpus.py)')
+    parser.add_argument('--module', action='append', choices=DECODE,
+                        help='only run the cases of this module (repeatable)')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='decoding runs per case (default: 3)')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds after which a case is given up on')
+    parser.add_argument('--output', help='file to write all results to')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='results file to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown or memory growth that counts'
+                             ' as a regression (default: 0.25)')
+    parser.add_argument('--in-process', metavar='CASE',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.in_process is not None:
+        print(json.dumps(run_case(args.corpus, json.loads(args.in_process),
+                                  args.runs)))
+        return
+
+    with open(os.path.join(args.corpus, 'manifest.json')) as f:
+        cases = json.load(f)['cases']
+    results = []
+    for case in cases:
+        if args.module and case['module'] not in args.module:
+            continue
+        result = run_in_subprocess(args.corpus, case, args.runs, args.timeout)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(args.corpus),
+                       'results': results}, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit('Regressions:\n' + '\n'.join(regressions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Measure how long ./detect.py takes for input that only ever reaches the text
+decoders, and fail if that's over budget or if any heavy dependency got
+imported along the way.
+
+    benchmarks/startup.py [--budget-ms 100] [--runs 20]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEXT_ONLY_INPUT = 'c2VjcmV0IG1lc3NhZ2UK'
+HEAVY_MODULES = ('matplotlib', 'numpy', 'PIL')
+
+
+def time_runs(command, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=REPO, check=True,
+                       stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def heavy_imports(data):
+    code = (
+        'import contextlib, io, sys\n'
+        'import detect\n'
+        'with contextlib.redirect_stdout(io.StringIO()):\n'
+        f'    detect.main([{data!r}])\n'
+        f'print(" ".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n'
+    )
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO,
+                            check=True, capture_output=True, text=True)
+    return result.stdout.split()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--budget-ms', type=float, default=100)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    interpreter = time_runs([sys.executable, '-c', 'pass'], args.runs)
+    detect = time_runs([sys.executable, 'detect.py', TEXT_ONLY_INPUT],
+                       args.runs)
+    imported = heavy_imports(TEXT_ONLY_INPUT)
+    result = {
+        'benchmark': 'startup',
+        'input': TEXT_ONLY_INPUT,
+        'runs': args.runs,
+        'interpreter_ms': 1000 * statistics.median(interpreter),
+        'detect_ms': 1000 * statistics.median(detect),
+        'budget_ms': args.budget_ms,
+        'heavy_imports': imported,
+    }
+    print(json.dumps(result))
+
+    if imported:
+        sys.exit(f'Heavy modules imported on the text-only path: {imported}')
+    if result['detect_ms'] > args.budget_ms:
+        sys.exit(f'Over budget: {result["detect_ms"]:.1f}ms'
+                 f' > {args.budget_ms}ms')
+
+
+if __name__ == "__main__":
+    main()
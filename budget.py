@@ -0,0 +1,107 @@
+"""
+Limits on how much work a decode run may do, so that untrusted input can't
+keep it busy, or make it grow, without bound.
+
+A run has a Budget. keep_decoding enforces the limits on the search as a
+whole: its total time, how deep it goes and how many blobs it queues. The
+limits on a single decoder invocation are enforced cooperatively: within
+`limit(...)`, long-running loops call `checkpoint()` and code that is about
+to allocate a blob calls `check_size(...)`, both of which raise
+BudgetExceeded once the invocation is over budget.
+"""
+
+from collections import namedtuple
+import contextlib
+import time
+
+# All limits are optional; None means unlimited.
+#  - seconds: wall-clock time for the whole run
+#  - depth: number of decoders in a row that led to a blob
+#  - nodes: number of derived blobs to queue
+#  - decoder_seconds: wall-clock time per decoder invocation
+#  - blob_size: size in bytes of any blob a decoder creates
+Budget = namedtuple('Budget', 'seconds depth nodes decoder_seconds blob_size',
+                    defaults=(None, None, None, None, None))
+
+UNLIMITED = Budget()
+
+# What a run left out: why, the decoders that led to it, and details
+Truncation = namedtuple('Truncation', 'reason chain detail')
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+# Limits of the decoder invocation in progress, per process
+_deadline = None
+_blob_size = None
+
+
+@contextlib.contextmanager
+def limit(seconds=None, blob_size=None):
+    """Enforce time and blob size limits on the code run within."""
+    global _deadline, _blob_size
+
+    saved = _deadline, _blob_size
+    if seconds is not None:
+        deadline = time.monotonic() + seconds
+        _deadline = deadline if _deadline is None else min(_deadline, deadline)
+    if blob_size is not None:
+        _blob_size = (blob_size if _blob_size is None
+                      else min(_blob_size, blob_size))
+    try:
+        yield
+    finally:
+        _deadline, _blob_size = saved
+
+
+def checkpoint():
+    """Raise BudgetExceeded if the current invocation has run out of time."""
+    if _deadline is not None and time.monotonic() > _deadline:
+        raise BudgetExceeded('out of time')
+
+
+def check_size(size):
+    """Raise BudgetExceeded if a blob of `size` bytes would be too big."""
+    if _blob_size is not None and size > _blob_size:
+        raise BudgetExceeded(
+            f'blob of {size} bytes is over the limit of {_blob_size}'
+        )
+
+
+def add_arguments(parser, defaults=UNLIMITED):
+    """Add options for all limits of a Budget to an argparse parser."""
+    def default(value):
+        return 'unlimited' if value is None else value
+
+    parser.add_argument(
+        '--max-seconds', type=float, default=defaults.seconds,
+        help='wall-clock time limit for decoding one input'
+             f' (default: {default(defaults.seconds)})',
+    )
+    parser.add_argument(
+        '--max-depth', type=int, default=defaults.depth,
+        help='maximum number of decoders in a row'
+             f' (default: {default(defaults.depth)})',
+    )
+    parser.add_argument(
+        '--max-nodes', type=int, default=defaults.nodes,
+        help='maximum number of derived blobs to decode per input'
+             f' (default: {default(defaults.nodes)})',
+    )
+    parser.add_argument(
+        '--decoder-seconds', type=float, default=defaults.decoder_seconds,
+        help='wall-clock time limit for one decoder on one blob'
+             f' (default: {default(defaults.decoder_seconds)})',
+    )
+    parser.add_argument(
+        '--max-blob-size', type=int, default=defaults.blob_size,
+        help='maximum size in bytes of a derived blob'
+             f' (default: {default(defaults.blob_size)})',
+    )
+
+
+def from_arguments(args):
+    return Budget(args.max_seconds, args.max_depth, args.max_nodes,
+                  args.decoder_seconds, args.max_blob_size)
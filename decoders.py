@@ -0,0 +1,75 @@
+"""
+Registry of everything that can decode a blob into other blobs.
+
+Decoders register themselves with a signature: the magic bytes the blob has to
+start with, or the alphabet class it has to be in, plus length constraints.
+All signatures are indexed up front, so finding the candidate decoders for a
+blob takes a couple of dict lookups, and expensive probes (like opening the
+blob as an image) only happen for blobs that match.
+"""
+
+from collections import defaultdict, namedtuple
+
+Decoder = namedtuple('Decoder', 'name function min_length max_length')
+
+# Alphabet classes a blob can be routed by
+ALPHABETS = (
+    'binary',  # Exactly two distinct byte values
+    'any',  # Anything else
+)
+
+# Number of leading bytes the magic index is keyed by
+MAGIC_PREFIX_LENGTH = 2
+
+_by_magic_prefix = defaultdict(list)  # Prefix -> [(magic, Decoder)]
+_by_alphabet = defaultdict(list)  # Alphabet class -> [Decoder]
+
+
+def register(name, magic=(), alphabet=None, min_length=1, max_length=None):
+    """
+    Register the decorated function, which takes a blob and its profile (see
+    alphabets.profile) and yields the blobs decoded from it, for blobs that
+    start with any of the `magic` byte strings or, failing that, that are in
+    the `alphabet` class.
+    """
+    assert alphabet is None or alphabet in ALPHABETS, alphabet
+
+    def decorator(function):
+        decoder = Decoder(name, function, min_length, max_length)
+        for signature in magic:
+            assert len(signature) >= MAGIC_PREFIX_LENGTH, signature
+            prefix = signature[:MAGIC_PREFIX_LENGTH]
+            _by_magic_prefix[prefix].append((signature, decoder))
+        if alphabet is not None:
+            _by_alphabet[alphabet].append(decoder)
+        return function
+
+    return decorator
+
+
+def has_magic(data):
+    """Return whether data starts with the magic bytes of any decoder."""
+    prefix = bytes(data[:MAGIC_PREFIX_LENGTH])
+    return any(data[:len(magic)] == magic
+               for magic, _ in _by_magic_prefix.get(prefix, ()))
+
+
+def route(data, alphabet, by_magic=True):
+    """
+    Return the decoders to try on data: the ones whose magic bytes it starts
+    with if there are any, or otherwise the ones for its alphabet class.
+
+    With by_magic=False, only the ones for its alphabet class are returned,
+    e.g. for data that only happens to start with the magic bytes.
+    """
+    decoders = []
+    if by_magic:
+        prefix = bytes(data[:MAGIC_PREFIX_LENGTH])
+        decoders = [decoder
+                    for magic, decoder in _by_magic_prefix.get(prefix, ())
+                    if data[:len(magic)] == magic]
+    if len(decoders) == 0:
+        decoders = _by_alphabet.get(alphabet, [])
+    return [decoder for decoder in decoders
+            if len(data) >= decoder.min_length
+            and (decoder.max_length is None or len(data) <= decoder.max_length)]
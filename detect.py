@@ -1,59 +1,484 @@
 #!/usr/bin/env python
 
-from collections import deque
+import argparse
+from collections import OrderedDict, deque
+import contextlib
+import hashlib
+import heapq
+import io
+import itertools
+import mmap
+import os
 import shutil
-import sys
+import time
 
+import alphabets
+import budget
+import decoders
 import image
-import text
+import morse
+import scoring
+import tracing
+# Imported for the decoders they register
+import gif  # noqa: F401
+import jpeg  # noqa: F401
+import png  # noqa: F401
+import text  # noqa: F401
 
+# Derived blobs scoring lower than this are not decoded any further. Random
+# bytes score around 0.2, text and encoded text 0.5 and up.
+MIN_SCORE = 0.3
 
-def keep_decoding(data):
-    derived_data = deque([data])
-    while len(derived_data) > 0:
-        data = derived_data.pop()
-        print(f'Handling {pprint_data(data)}')
-        for data in decode(data):
-            print(f'Putting on the queue: {pprint_data(data)}')
-            derived_data.appendleft(data)
+
+class TranspositionTable:
+    """
+    Remembers which blobs were already handled during a run, keyed by a digest
+    of their content, together with the chain of decoders they were first
+    derived by, and every (parent digest, decoder) they were derived by: the
+    edges of the provenance graph.
+
+    Only digests are stored, and the least recently seen ones are evicted once
+    there are more than `max_entries` of them, so memory use stays bounded.
+    Edges can point to parents that have been evicted since.
+    """
+
+    def __init__(self, max_entries=100_000):
+        self.max_entries = max_entries
+        # Digest -> chain of decoder names, list of (parent digest, decoder)
+        self._entries = OrderedDict()
+
+    def __contains__(self, digest):
+        return digest in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, digest, chain=(), parent=None):
+        """
+        Record `digest`, derived by `chain` from the blob with digest
+        `parent`, and return whether it's new.
+        """
+        new = digest not in self._entries
+        if new:
+            self._entries[digest] = (chain, [])
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(digest)
+        if parent is not None:
+            self._entries[digest][1].append((parent, chain[-1]))
+        return new
+
+    def provenance(self, digest):
+        """Return the chain of decoders digest was first derived by."""
+        entry = self._entries.get(digest)
+        return None if entry is None else entry[0]
+
+    def parents(self, digest):
+        """Return every (parent digest, decoder) digest was derived by."""
+        entry = self._entries.get(digest)
+        return [] if entry is None else list(entry[1])
+
+
+class SearchQueue:
+    """
+    Queue of blobs to decode, most plausible first.
+
+    Blobs with the same score come out last in, first out, so that among
+    equally plausible blobs the search still goes deep first.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, score, data, chain, profile=None):
+        heapq.heappush(self._heap,
+                       (-score, -next(self._counter), data, chain, profile))
+
+    def pop(self):
+        """Return the most plausible (data, chain, profile)."""
+        _, _, data, chain, profile = heapq.heappop(self._heap)
+        return data, chain, profile
+
+    def clear(self):
+        self._heap.clear()
+
+
+def keep_decoding(data, jobs=1, window=None, on_finding=None,
+                  min_score=MIN_SCORE, limits=budget.UNLIMITED,
+                  on_truncation=None):
+    """
+    Best-first search over everything that can be decoded from `data`.
+
+    Every derived blob is scored (see scoring.score) and the most plausible
+    ones are decoded first. Blobs scoring below `min_score` are pruned.
+
+    With `jobs` > 1, queued blobs are decoded in a pool of worker processes,
+    with at most `window` of them in flight. Results are still handled in
+    the order they were taken from the queue, so the output is the same as
+    for a serial run with the same window.
+
+    Every newly derived blob is passed to `on_finding(data, chain, score)`,
+    where chain lists the names of the decoders that led to it.
+
+    The search stays within the `limits` of a budget.Budget. Everything left
+    out because of them is passed to `on_truncation(truncation)` as a
+    budget.Truncation, and listed at the end. Running out of nodes or time
+    ends the search, with one truncation for everything it drops.
+
+    Returns the run's TranspositionTable, which holds how every blob handled
+    was derived.
+    """
+    truncations = []
+
+    def truncate(reason, chain, detail):
+        print(f'Truncated ({reason}): {detail}')
+        truncation = budget.Truncation(reason, chain, detail)
+        truncations.append(truncation)
+        if on_truncation is not None:
+            on_truncation(truncation)
+
+    start = time.monotonic()
+    n_nodes = 0
+    seen = TranspositionTable()
+    seen.add(digest(data))
+    derived_data = SearchQueue()
+    derived_data.push(scoring.MAGIC_SCORE, data, ())
+    if jobs == 1:
+        expansions = _expand_serially(derived_data, limits)
+    else:
+        expansions = _expand_in_pool(derived_data, jobs, window or 2 * jobs,
+                                     limits)
+
+    out_of_nodes = False
+    for data, chain, derived in expansions:
+        parent = digest(data)
+        for decoder, data in derived:
+            if isinstance(data, budget.BudgetExceeded):
+                truncate('decoder', chain + (decoder,), str(data))
+                continue
+            data_digest = digest(data)
+            if not seen.add(data_digest, chain + (decoder,), parent):
+                first = " -> ".join(seen.provenance(data_digest) or ())
+                print(f'Already handled ({decoder}), first found'
+                      f' {"via " + first if first else "as input"}:'
+                      f' {pprint_data(data)}')
+                continue
+            profile = alphabets.profile(data)
+            score = scoring.score(
+                data, profile,
+                alphabets.profile(data[:scoring.PREFIX_LENGTH]))
+            if score < min_score:
+                print(f'Pruning ({decoder}, score {score:.2f}):'
+                      f' {pprint_data(data)}')
+                continue
+            if limits.depth is not None and len(chain) >= limits.depth:
+                truncate('depth', chain + (decoder,), pprint_data(data))
+                continue
+            if limits.nodes is not None and n_nodes >= limits.nodes:
+                # Stop the search, rather than truncating every blob that
+                # would still be derived
+                truncate('nodes', chain + (decoder,),
+                         f'{len(derived_data) + 1} blobs dropped, from'
+                         f' {pprint_data(data)}')
+                derived_data.clear()
+                out_of_nodes = True
+                break
+            print(f'Putting on the queue ({decoder}, score {score:.2f}):'
+                  f' {pprint_data(data)}')
+            derived_data.push(score, data, chain + (decoder,), profile)
+            n_nodes += 1
+            if on_finding is not None:
+                on_finding(data, chain + (decoder,), score)
+        tracing.flush(depth=len(chain))
+        if out_of_nodes:
+            break
         if len(derived_data) > 0:
+            if (limits.seconds is not None
+                    and time.monotonic() - start > limits.seconds):
+                truncate('time', (),
+                         f'{len(derived_data)} blobs left on the queue')
+                break
             print('-' * shutil.get_terminal_size().columns)
 
+    if len(truncations) > 0:
+        print('-' * shutil.get_terminal_size().columns)
+        print(f'Truncated {len(truncations)} branches:')
+        for truncation in truncations:
+            print(f'  {truncation.reason}'
+                  f' ({" -> ".join(truncation.chain) or "input"}):'
+                  f' {truncation.detail}')
+    return seen
 
-def decode(data):
-    n_unique = len(set(data))
-    print(f'Length {len(data)}, {n_unique} unique,'
-          f' min {min(data)}, max {max(data)}, range {max(data) - min(data)}')
-
-    if n_unique == 2:
-        print('Only two unique values; converting to bitstring.')
-        val0 = data[0]
-        bit_str1 = b''.join(b'0' if bit == val0 else b'1' for bit in data)
-        yield bit_str1
-        print('Trying reversed.')
-        bit_str2 = b''.join(b'1' if bit == val0 else b'0' for bit in data)
-        yield bit_str2
-    elif image.is_image(data):
-        print('Image detected.')
-        yield from image.try_decode(data)
-    else:
-        print('Trying to decode as text.')
-        yield from text.try_decode_bytes(data)
+
+def _expand_serially(derived_data, limits):
+    while len(derived_data) > 0:
+        data, chain, profile = derived_data.pop()
+        print(f'Handling {pprint_data(data)}')
+        yield data, chain, decode(data, profile, limits)
 
 
-def pprint_data(data):
-    s = repr(data)
-    return s[:200] + ('<snip>' if len(s) > 200 else '')
+def _expand_in_pool(derived_data, jobs, window, limits):
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(jobs, initializer=image.configure,
+                             initargs=(image.VISUALS, image.OUTPUT_DIR,
+                                       image.DECODE_FRAMES)) \
+            as pool:
+        try:
+            yield from _schedule(pool, derived_data, window, limits)
+        finally:
+            # Don't wait for blobs nobody will look at if the search stops
+            pool.shutdown(cancel_futures=True)
+
+
+def _schedule(pool, derived_data, window, limits):
+    in_flight = deque()
+    while len(derived_data) > 0 or len(in_flight) > 0:
+        while len(derived_data) > 0 and len(in_flight) < window:
+            data, chain, profile = derived_data.pop()
+            if isinstance(data, bytes):
+                future = pool.submit(_decode_captured, data, profile,
+                                     limits)
+            else:
+                # A memory-mapped input can't be sent to a worker without
+                # copying it, so it's decoded here instead.
+                future = None
+            in_flight.append((data, chain, profile, future))
+
+        # Always wait for the oldest job, to keep the order deterministic
+        data, chain, profile, future = in_flight.popleft()
+        print(f'Handling {pprint_data(data)}')
+        if future is None:
+            yield data, chain, decode(data, profile, limits)
+            continue
+        try:
+            log, derived, spans = future.result()
+        except Exception as e:
+            # Decoders' own exceptions are caught in the worker, so this is
+            # anything else that went wrong there, like a worker dying
+            print(f'Failed to decode in a worker: {type(e).__name__}: {e}')
+            yield data, chain, []
+            continue
+        print(log, end='')
+        tracing.extend(spans)
+        yield data, chain, derived
 
 
-def main(filename_or_data):
+def _decode_captured(data, profile=None, limits=budget.UNLIMITED):
+    """
+    Decode in a worker process, returning the log and the trace spans instead
+    of printing and recording them.
+    """
+    with contextlib.redirect_stdout(io.StringIO()) as log:
+        derived = list(decode(data, profile, limits))
+    return log.getvalue(), derived, tracing.take()
+
+
+def decode(data, profile=None, limits=budget.UNLIMITED):
+    """
+    Yield (decoder name, derived blob) for everything the decoders that apply
+    to data derive from it.
+
+    A decoder that goes over the time or blob size limits is cancelled, which
+    is reported by yielding the BudgetExceeded instead of a blob. A decoder
+    that fails is logged and skipped, keeping what it derived until then.
+    If all decoders for the magic bytes data starts with fail before deriving
+    anything, it's decoded as if it didn't start with them.
+    """
+    if len(data) == 0:
+        return
+    if profile is None:
+        profile = alphabets.profile(data)
+    print(f'Length {profile.length}, {profile.n_unique} unique,'
+          f' min {profile.min}, max {profile.max},'
+          f' range {profile.max - profile.min}')
+
+    alphabet = 'binary' if profile.n_unique == 2 else 'any'
+    rejected = []
+    for decoder in decoders.route(data, alphabet):
+        rejected.append(
+            (yield from _run_decoder(decoder, data, profile, limits)))
+    if decoders.has_magic(data) and len(rejected) > 0 and all(rejected):
+        # It only starts like a file of that format
+        print('Not in the format of its magic bytes after all.')
+        for decoder in decoders.route(data, alphabet, by_magic=False):
+            yield from _run_decoder(decoder, data, profile, limits)
+
+
+def _run_decoder(decoder, data, profile, limits):
+    """
+    Yield (decoder name, derived blob) for what decoder derives from data,
+    and return whether it rejected data: failed before deriving anything.
+    """
+    print(f'Trying to decode as {decoder.name}.')
+    invocation = tracing.Invocation(decoder.name, len(data))
+    n_derived = 0
     try:
-        with open(filename_or_data, 'rb') as file:
-            data = file.read()
-    except Exception:
-        data = filename_or_data.encode()
-    return keep_decoding(data)
+        with budget.limit(limits.decoder_seconds, limits.blob_size):
+            blobs = decoder.function(data, profile)
+            for derived in invocation.track(blobs):
+                budget.check_size(len(derived))
+                n_derived += 1
+                yield decoder.name, derived
+                budget.checkpoint()
+    except budget.BudgetExceeded as e:
+        print(f'Cancelled {decoder.name}: {e}')
+        invocation.error = f'{type(e).__name__}: {e}'
+        yield decoder.name, e
+    except Exception as e:
+        print(f'Failed to decode as {decoder.name}:'
+              f' {type(e).__name__}: {e}')
+        invocation.error = f'{type(e).__name__}: {e}'
+        return n_derived == 0
+    finally:
+        invocation.finish()
+    return False
+
+
+@decoders.register('bitstring', alphabet='binary')
+def decode_bitstring(data, profile):
+    """
+    Read a blob of two distinct byte values as bits, both ways round, and
+    yield them packed into bytes at every bit offset and in both bit orders,
+    as well as decoded as morse code.
+
+    The bits are packed straight from the blob, without going through a
+    string of ASCII '0's and '1's.
+    """
+    import numpy as np
+
+    print('Only two unique values; converting to bits.')
+    val1 = profile.max if data[0] == profile.min else profile.min
+    bits = np.frombuffer(data, np.uint8) == val1
+    for polarity, polarised in (('', bits), ('reversed ', ~bits)):
+        print(f'Packing {polarity}bits at all offsets, in both bit orders.')
+        for offset in range(8):
+            for bitorder in ('big', 'little'):
+                yield np.packbits(polarised[offset:],
+                                  bitorder=bitorder).tobytes()
+        yield from morse.try_decode(polarised)
+
+
+def digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def pprint_data(data):
+    s = repr(bytes(data[:200]))
+    return s[:200] + ('<snip>' if len(s) > 200 or len(data) > 200 else '')
+
+
+@contextlib.contextmanager
+def open_input(filename):
+    """
+    Map a file into memory, yielding a read-only memoryview on its contents.
+
+    This way, even huge files can be handed to the format parsers without
+    reading them into memory.
+    """
+    with open(filename, 'rb') as file:
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            yield b''
+            return
+        try:
+            yield memoryview(mapped)
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                # Views on it are still around (e.g. in a traceback), so it
+                # will only be unmapped once those are garbage collected.
+                pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Find hidden messages in a file or literal data.'
+    )
+    parser.add_argument('filename_or_data')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='number of worker processes to decode in (0: one per CPU)',
+    )
+    parser.add_argument(
+        '--window', type=int,
+        help='maximum number of blobs being decoded at once'
+             ' (default: twice the number of jobs)',
+    )
+    parser.add_argument(
+        '--visuals', choices=('prompt', 'save', 'skip'), default='prompt',
+        help='whether to ask to show images and histograms, save them to'
+             ' files without asking, or skip them (default: prompt)',
+    )
+    parser.add_argument(
+        '--output-dir', default='.',
+        help='directory to save images and histograms to (default: .)',
+    )
+    parser.add_argument(
+        '--decode-frames', type=int, default=0,
+        help='number of frames of an animated GIF to decode the image data'
+             ' of, to look for data hidden in it (default: 0, all of them)',
+    )
+    parser.add_argument(
+        '--min-score', type=float, default=MIN_SCORE,
+        help='plausibility score below which derived blobs are not decoded'
+             f' any further, between 0 and 1 (default: {MIN_SCORE})',
+    )
+    parser.add_argument(
+        '--trace', metavar='FILE',
+        help='write a span per decoder invocation to FILE',
+    )
+    parser.add_argument(
+        '--trace-format', choices=('jsonl', 'chrome'), default='jsonl',
+        help='write the spans as JSON lines, or in the Chrome trace format'
+             ' (default: jsonl)',
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='print a table of where the time went at the end',
+    )
+    budget.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    image.configure(args.visuals, args.output_dir, args.decode_frames)
+    jobs = args.jobs or os.cpu_count()
+    with contextlib.ExitStack() as stack:
+        try:
+            data = stack.enter_context(open_input(args.filename_or_data))
+        except (OSError, ValueError):
+            data = args.filename_or_data.encode()
+        if args.trace is not None:
+            trace_file = stack.enter_context(open(args.trace, 'w'))
+            if args.trace_format == 'chrome':
+                trace = tracing.ChromeTrace(trace_file)
+            else:
+                trace = tracing.JsonLinesTrace(trace_file)
+            tracing.add_hook(trace)
+            stack.callback(trace.close)
+        if args.profile:
+            profile = tracing.Profile()
+            tracing.add_hook(profile)
+            stack.callback(print_profile, profile)
+        try:
+            return keep_decoding(data, jobs=jobs, window=args.window,
+                                 min_score=args.min_score,
+                                 limits=budget.from_arguments(args))
+        finally:
+            image.wait_for_renders()
+
+
+def print_profile(profile):
+    print('-' * shutil.get_terminal_size().columns)
+    print('\n'.join(profile.table()))
 
 
 if __name__ == "__main__":
-    main(sys.argv[1])
+    main()
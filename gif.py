@@ -13,23 +13,149 @@ Grammar:
 
 Not all GIFs follow that grammar though: some have standalone graphic control
 extensions, not followed by a Graphic-Rendering Block.
+
+The parse functions that can run into hidden data are generators: they yield
+that data and return the offset after what they parsed.
+
+Frames aren't decoded while parsing: they're indexed in a frame table instead,
+with where their palette and image data are, so any frame can be looked at
+later without going through the ones before it.
 """
 
+from collections import namedtuple
+
+import budget
+import decoders
+import image
+import lzw
+
+# A color table: the offset of its first color, and its number of colors
+Palette = namedtuple('Palette', 'offset size')
+
+# The logical screen: its dimensions and its global color table (or None)
+Screen = namedtuple('Screen', 'width height palette')
+
+# A graphic control extension; transparent_index is None for no transparency
+GraphicControl = namedtuple('GraphicControl',
+                            'disposal_method delay_time transparent_index')
+
+# An entry of the frame table: the image descriptor, the color table that
+# applies to the frame (its local one, or else the global one), the graphic
+# control extension before it (or None), and the offset of its image data
+# (starting with the LZW minimum code size)
+Frame = namedtuple('Frame', 'left top width height interlaced palette'
+                            ' local_palette graphic_control data_offset')
+
+
+# Application extensions that only hold an animation loop count
+LOOPING_APPLICATIONS = (b'NETSCAPE2.0', b'ANIMEXTS1.0')
+
+# First row and step between rows of the passes of interlaced images
+INTERLACED_PASSES = ((0, 8), (4, 8), (2, 4), (1, 2))
+
+
+@decoders.register('gif', magic=(b'GIF87a', b'GIF89a'))
+def try_decode(data, _profile):
+    return image.try_decode(data, check_normal_format)
+
 
 def check_normal_format(data):
+    """
+    Walk the blocks, yielding any data hidden in them, then the first colors
+    of the frames' palettes, and then what's hidden in the image data of the
+    frames (only the first image.DECODE_FRAMES if set). Returns the frame
+    table.
+    """
+    # Parse straight from the (possibly memory-mapped) buffer, without copies
+    data = memoryview(data)
     header = data[:6]
-    assert header == b'GIF89a'
+    assert header in (b'GIF87a', b'GIF89a')
 
-    offset = parse_logical_screen(data, 6)
+    screen, offset = parse_logical_screen(data, 6)
 
+    frames = []
     while True:
         if data[offset:offset + 1] == b';':
             break
-        offset = parse_chunk(data, offset)
+        offset = yield from parse_chunk(data, offset, screen, frames)
         _log('---')
 
     assert len(data) == offset + 1
 
+    if len(frames) > 1:
+        _log(f'Animated: {len(frames)} frames')
+        yield from check_first_palette_colors(data, frames)
+
+    # Decoding is the slow part, so it comes last, and can be capped
+    n_decoded = image.DECODE_FRAMES or len(frames)
+    if n_decoded < len(frames):
+        _log(f'Only decoding the image data of the first {n_decoded} of'
+             f' {len(frames)} frames (see --decode-frames)')
+    yield from check_image_data(data, frames[:n_decoded])
+    return frames
+
+
+def check_image_data(data, frames):
+    """
+    Decode every frame, and yield whatever was hidden in the image data:
+    pixels past the end of the frame, and data after the end-of-information
+    code, each concatenated over all frames.
+    """
+    excess = []
+    trailing = []
+    for i, frame in enumerate(frames):
+        _, decoded = decode_frame(data, frame)
+        if not decoded.complete:
+            _log(f'Frame {i}: image data ends without an end code')
+        if len(decoded.excess) > 0:
+            _log(f'Frame {i}: {len(decoded.excess)} pixels more than its'
+                 f' dimensions need')
+            excess.append(decoded.excess)
+        if len(decoded.trailing) > 0:
+            _log(f'Frame {i}: {len(decoded.trailing)} bytes of image data'
+                 f' after the end code')
+            trailing.append(decoded.trailing)
+    if len(excess) > 0:
+        yield b''.join(excess)
+    if len(trailing) > 0:
+        yield b''.join(trailing)
+
+
+def decode_frame(data, frame):
+    """
+    Decode the image data of a frame, returning its color indices as a NumPy
+    array of its height by its width, and the lzw.Decoded result.
+    """
+    import numpy as np
+
+    budget.check_size(frame.width * frame.height)
+    decoded = lzw.decode(iter_subblocks(data, frame.data_offset + 1),
+                         data[frame.data_offset], frame.width * frame.height)
+    pixels = np.frombuffer(decoded.pixels, np.uint8) \
+        .reshape(frame.height, frame.width)
+    if frame.interlaced:
+        # Rows are stored in four passes: every 8th row from row 0, every
+        # 8th from row 4, every 4th from row 2 and every 2nd from row 1
+        order = np.concatenate([np.arange(start, frame.height, step)
+                                for start, step in INTERLACED_PASSES])
+        deinterlaced = np.empty_like(pixels)
+        deinterlaced[order] = pixels
+        pixels = deinterlaced
+    return pixels, decoded
+
+
+def check_first_palette_colors(data, frames):
+    """Look for patterns in the first color of every frame's palette."""
+    import numpy as np
+
+    offsets = np.array([frame.palette.offset for frame in frames
+                        if frame.palette is not None], dtype=np.intp)
+    if len(offsets) == 0:
+        return
+    colors = np.frombuffer(data, np.uint8)[offsets[:, np.newaxis]
+                                           + np.arange(3)]
+    yield from image.check_first_palette_colors(colors)
+
 
 def parse_logical_screen(data, offset):
     width = parse_int(data[offset:offset + 2])
@@ -57,26 +183,36 @@ def parse_logical_screen(data, offset):
         _log('Pixel aspect ratio:', pixel_aspect_ratio)
 
     offset += 7
+    palette = None
     if global_color_table_flag != 0:
         # Can't do much wrong with the table itself, I guess?
         # You could potentially hide some data in unused colors
-        offset += 3 * 2 ** (global_color_table_size + 1)
-    return offset
+        palette = Palette(offset, 2 ** (global_color_table_size + 1))
+        offset += 3 * palette.size
+    return Screen(width, height, palette), offset
 
 
-def parse_chunk(data, offset):
+def parse_chunk(data, offset, screen, frames):
+    """Parse a block, adding it to frames if it's an image."""
     assert data[offset:offset + 1] in b',!'
     if data[offset:offset + 1] == b',':
         _log('Image.')
-        return parse_table_based_image(data, offset + 1)
+        frame, offset = parse_table_based_image(data, offset + 1, screen)
+        frames.append(frame)
+        return offset
     elif data[offset:offset + 1] == b'!':
         offset += 1
         if data[offset] == 0xf9:
             _log('Graphic control extension.')
-            offset = parse_graphic_control_extension(data, offset + 1)
+            graphic_control, offset = \
+                parse_graphic_control_extension(data, offset + 1)
             assert data[offset:offset + 1] in b',!'
             if data[offset:offset + 1] == b',':
-                return parse_table_based_image(data, offset + 1)
+                frame, offset = parse_table_based_image(
+                    data, offset + 1, screen, graphic_control
+                )
+                frames.append(frame)
+                return offset
             elif data[offset:offset + 1] == b'!':
                 offset += 1
                 if data[offset] != 0x01:
@@ -89,13 +225,14 @@ def parse_chunk(data, offset):
             return parse_plain_text_extension(data, offset + 1)
         elif data[offset] == 0xff:
             _log('Application extension.')
-            return parse_application_extension(data, offset + 1)
+            return (yield from parse_application_extension(data, offset + 1))
         elif data[offset] == 0xfe:
             _log('Comment extension.')
-            return parse_comment_extension(data, offset + 1)
+            return (yield from parse_comment_extension(data, offset + 1))
 
 
-def parse_table_based_image(data, offset):
+def parse_table_based_image(data, offset, screen, graphic_control=None):
+    """Parse an image, without decoding it, returning its frame table entry."""
     # Image descriptor
     left_pos = parse_int(data[offset:offset + 2])
     top_pos = parse_int(data[offset + 2:offset + 4])
@@ -120,18 +257,24 @@ def parse_table_based_image(data, offset):
     offset += 9
 
     # Optional local color table
+    palette = screen.palette
     if color_table_flag != 0:
         # Can't do much wrong with the table itself, I guess?
         # You could potentially hide some data in unused colors
-        offset += 3 * 2 ** (color_table_size + 1)
+        palette = Palette(offset, 2 ** (color_table_size + 1))
+        offset += 3 * palette.size
+
+    frame = Frame(left_pos, top_pos, width, height, bool(interlace_flag),
+                  palette, color_table_flag != 0, graphic_control, offset)
 
     # Image data
     lzw_minimum_code_size = data[offset]
-    offset, _subdata = parse_subblocks(data, offset + 1)
+    # The frame table says where the pixels are, so don't gather them here
+    offset, _ = parse_subblocks(data, offset + 1, keep=False)
 
     block_terminator = data[offset]
     assert block_terminator == 0
-    return offset + 1
+    return frame, offset + 1
 
 
 def parse_graphic_control_extension(data, offset):
@@ -151,43 +294,69 @@ def parse_graphic_control_extension(data, offset):
         transparent_color_index = data[offset + 4]
         _log(f'Transparent color index: {transparent_color_index}')
     else:
+        transparent_color_index = None
         _log('No transparent color')
     block_terminator = data[offset + 5]
     assert block_terminator == 0
-    return offset + 6
+    graphic_control = GraphicControl(disposal_method, delay_time,
+                                     transparent_color_index)
+    return graphic_control, offset + 6
 
 
 def parse_comment_extension(data, offset):
     offset, subdata = parse_subblocks(data, offset)
-    _log(f'Comment: "{subdata.decode("ascii")}"')
+    _log(f'Comment: "{subdata.decode("ascii", errors="replace")}"')
+    if len(subdata) > 0:
+        yield subdata
     block_terminator = data[offset]
     assert block_terminator == 0
     return offset + 1
 
 
-def parse_subblocks(data, offset):
-    subdata = b''
+def iter_subblocks(data, offset):
+    """Yield the data sub-blocks starting at offset, as views."""
+    while data[offset] != 0:
+        block_size = data[offset]
+        yield data[offset + 1:offset + 1 + block_size]
+        offset += block_size + 1
+
+
+def parse_subblocks(data, offset, keep=True):
+    """
+    Walk the data sub-blocks starting at offset and return the offset of the
+    block terminator, together with the concatenated data.
+
+    The blocks are gathered as views and only joined once at the end, or not
+    at all if `keep` is false (in which case None is returned as data).
+    """
+    blocks = []
     last_block_size = 254
     while data[offset] != 0:
         block_size = data[offset]
         if block_size < 254 and last_block_size < 254:
             _log('Encountered sub-block size < 254 before last:',
                  last_block_size)
-        subdata += data[offset + 1: offset + 1 + block_size]
+        if keep:
+            blocks.append(data[offset + 1:offset + 1 + block_size])
         offset += block_size + 1
         last_block_size = block_size
-    return offset, subdata
+    return offset, b''.join(blocks) if keep else None
 
 
 def parse_application_extension(data, offset):
     block_size = data[offset]
     assert block_size == 11
-    application_identifier = data[offset + 1:offset + 9]
+    application_identifier = bytes(data[offset + 1:offset + 9])
     _log(f'Application identifier: {application_identifier.decode("ascii")}')
-    auth_code = data[offset + 9:offset + 12]
+    auth_code = bytes(data[offset + 9:offset + 12])
     _log(f'Application authentication code: {auth_code}')
     offset, subdata = parse_subblocks(data, offset + 12)
     _log('Application data:', subdata)
+    is_loop_count = (application_identifier + auth_code
+                     in LOOPING_APPLICATIONS
+                     and len(subdata) == 3 and subdata[0] == 1)
+    if len(subdata) > 0 and not is_loop_count:
+        yield subdata
     block_terminator = data[offset]
     assert block_terminator == 0
     return offset + 1
@@ -1,49 +1,100 @@
 #!/usr/bin/env python
 """
 Find hidden information in images.
+
+Pillow, NumPy and Matplotlib take a while to import, so they're only imported
+by the functions that need them. That keeps start-up fast for input that isn't
+an image.
 """
 
 import io
+import itertools
 import math
+import os
 
-import matplotlib.pyplot as plt
-import PIL.Image
+import budget
+import steganalysis
+import tracing
 
-import gif
-import jpeg
-import png
 
+# What to do with visual artifacts (images per channel, histograms):
+#  - 'prompt': ask whether to show them in a window,
+#  - 'save': render them to PNG files in OUTPUT_DIR, in the background, or
+#  - 'skip': don't produce them at all.
+VISUALS = 'prompt'
+OUTPUT_DIR = '.'
 
-def is_image(data):
-    try:
-        PIL.Image.open(io.BytesIO(data))
-        return True
-    except Exception:
-        return False
+# Number of frames of an animation whose image data is decoded by the format
+# checks (0: all of them), to cap the time long animations take
+DECODE_FRAMES = 0
 
+_renderer = None
+_artifact_count = itertools.count()
 
-def try_decode(data):
-    image = PIL.Image.open(io.BytesIO(data))
-    image.verify()
 
-    # Verify closes the internal file pointer, so we have to open it again
-    image = PIL.Image.open(io.BytesIO(data))
-    _log(f'{image.format} image.')
+def configure(visuals='prompt', output_dir='.', decode_frames=0):
+    global VISUALS, OUTPUT_DIR, DECODE_FRAMES
+    assert visuals in ('prompt', 'save', 'skip'), visuals
+    assert decode_frames >= 0, decode_frames
+    VISUALS = visuals
+    OUTPUT_DIR = output_dir
+    DECODE_FRAMES = decode_frames
+    if visuals == 'save':
+        os.makedirs(output_dir, exist_ok=True)
+
+
+def wait_for_renders():
+    """Block until all artifacts that are being saved have been written."""
+    global _renderer
+    if _renderer is not None:
+        _renderer.shutdown(wait=True)
+        _renderer = None
 
-    if image.format == 'PNG':
-        png.check_normal_format(data)
-    elif image.format == 'GIF':
-        gif.check_normal_format(data)
-    elif image.format == 'JPEG':
-        jpeg.check_normal_format(data)
-    else:
-        raise NotImplementedError('Image format {image.format} not supported.')
+
+def try_decode(data, check_format):
+    """
+    Look for hidden data in an image, using `check_format` to check the
+    structure of its specific format.
+
+    The format modules register their decoders by signature and call this.
+    The structure is checked even if Pillow can't read the image, which fails
+    only if that doesn't find anything either.
+    """
+    with tracing.step('image.verify', len(data)):
+        try:
+            image = _open(data)
+            image.verify()
+            # Verify closes the internal file pointer, so we have to open it
+            # again
+            image = _open(data)
+        except Exception as e:
+            # Pillow rejects e.g. wrong CRCs, which can be where data is
+            # hidden, so the structure is still checked below
+            image = None
+            error = e
+    if image is not None:
+        width, height = image.size
+        budget.check_size(width * height * len(image.getbands()))
+        _log(f'{image.format} image.')
+
+    n_derived = 0
+    derived = check_format(data)
+    if derived is not None:
+        # The format check found hidden data of its own
+        for blob in derived:
+            n_derived += 1
+            yield blob
+
+    if image is None:
+        if n_derived == 0:
+            raise error
+        _log(f"Pillow can't read it: {type(error).__name__}: {error}")
+        return
 
     check_pixels(image)
+    check_lsb_statistics(image)
 
-    if getattr(image, 'is_animated', False):
-        _log(f'Animated: {image.n_frames} frames')
-        yield from check_first_palette_colors(image)
+    yield from extract_bit_planes(image)
 
 
 def check_pixels(image):
@@ -51,64 +102,208 @@ def check_pixels(image):
     _log(f'Extrema: {image.getextrema()}')
     _log(f'Entropy: {image.entropy()}')
 
+    name = f'{os.getpid()}-{next(_artifact_count)}'
+
     if image.mode == 'RGBA' and image.getextrema()[3] == (0, 0):
         _log("It's a transparent image, but there's something there.")
-        image.convert('RGB').show()
-
-    if _prompt_bool('Show image per channel?'):
-        for channel in image.split():
-            channel.show()
-
-    if _prompt_bool('Show histogram per channel?'):
-        show_histogram(image)
-
-
-def show_histogram(image):
+        _show(image.convert('RGB'), f'{name}-opaque')
+
+    if _wants('Show image per channel?'):
+        for band, channel in zip(image.getbands(), image.split()):
+            _show(channel, f'{name}-{band}')
+
+    if _wants('Show histogram per channel?'):
+        show_histogram(image, name)
+
+
+def check_lsb_statistics(image):
+    """
+    Run the chi-square and RS attacks (see steganalysis) on every channel,
+    logging how likely LSB embedding is, where, and how much of it.
+    """
+    width, height = image.size
+    with tracing.step('image.steganalysis',
+                      width * height * len(image.getbands())):
+        analyses = steganalysis.analyse(image)
+    if analyses is None:
+        _log('Too small for steganalysis')
+        return
+
+    name = f'{os.getpid()}-{next(_artifact_count)}'
+    show = _wants('Show steganalysis heatmaps?')
+    for analysis in analyses:
+        channel = analysis.channel
+        _log(f'Chi-square attack on {channel}: mean probability of'
+             f' embedding {analysis.chi_square.mean():.2f},'
+             f' over 0.5 in {(analysis.chi_square > 0.5).mean():.0%}'
+             ' of tiles')
+        _log(f'RS analysis on {channel}: about {analysis.rate:.0%} of'
+             f' pixels carry message bits, about {analysis.payload} bytes')
+        box = steganalysis.region(analysis.rs)
+        if box is not None:
+            _log(f'RS analysis on {channel}: likely embedding in {box}')
+        if show:
+            _show(steganalysis.heatmap(analysis.chi_square),
+                  f'{name}-{channel}-chi-square')
+            _show(steganalysis.heatmap(analysis.rs), f'{name}-{channel}-rs')
+
+
+def extract_bit_planes(image):
+    """
+    Yield every bit plane of every channel as packed bytes, in all of these
+    orders: by rows or by columns, with all channels interleaved or each
+    channel on its own, and starting at the most or least significant bit.
+
+    The pixels are laid out once in each of these orders, after which every
+    stream is just a mask and a pack over contiguous memory.
+    """
+    import numpy as np
+
+    if image.mode not in ('L', 'P', 'LA', 'RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    pixels = np.asarray(image)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+    bands = image.getbands()
+
+    layouts = []  # (description, channels, pixels with channels last/first)
+    for scan, scanned in (('rows', pixels),
+                          ('columns', pixels.transpose(1, 0, 2))):
+        layouts.append((scan, ''.join(bands),
+                        np.ascontiguousarray(scanned)))
+        if len(bands) > 1:
+            planar = np.ascontiguousarray(scanned.transpose(2, 0, 1))
+            layouts += [(scan, band, planar[i])
+                        for i, band in enumerate(bands)]
+
+    for plane in range(8):
+        _log(f'Extracting bit plane {plane}')
+        for scan, channels, layout in layouts:
+            budget.checkpoint()
+            # packbits packs any non-zero value as a 1 bit
+            bits = layout & (1 << plane)
+            for bitorder in ('big', 'little'):
+                packed = np.packbits(bits, axis=None, bitorder=bitorder)
+                if not packed.any() or (packed[:-1] == 0xff).all():
+                    # Nothing hidden in a constant plane
+                    break
+                yield packed.tobytes()
+
+
+def show_histogram(image, name='histogram'):
     histogram = image.histogram()
-    figure_count = 0
-    offset = 0
-    for band in image.getbands():
-        channel_histogram = histogram[offset:offset + 256]
+    bands = image.getbands()
+    if VISUALS == 'save':
+        path = os.path.join(OUTPUT_DIR, f'{name}-histogram.png')
+        _log(f'Saving histograms to {path}')
+        _render(_save_histogram, bands, histogram, path)
+        return
+
+    import matplotlib.pyplot as plt
+    for figure_count, band in enumerate(bands):
         plt.figure(figure_count)
-
-        for i in range(0, 256):
-            shade = {
-                'R': '#%02x%02x%02x' % (i, 0, 0),
-                'G': '#%02x%02x%02x' % (0, i, 0),
-                'B': '#%02x%02x%02x' % (0, 0, i),
-            }.get(band)
-            kwargs = {'color': shade, 'edgecolor': shade} if shade else {}
-            plt.bar(i, channel_histogram[i], alpha=0.7, **kwargs)
-
-        offset += 256
-        figure_count += 1
+        offset = 256 * figure_count
+        _plot_histogram(plt.gca(), band, histogram[offset:offset + 256])
     plt.show()
 
 
-def check_first_palette_colors(image):
-    colors = []
-    for frame_idx in range(image.n_frames):
-        image.seek(frame_idx)
-        colors.append(image.getpalette()[:3])
+def _save_histogram(bands, histogram, path):
+    from matplotlib.figure import Figure
+
+    # Pyplot isn't thread-safe, so we draw on an (Agg) figure of our own
+    figure = Figure(figsize=(6.4, 2.4 * len(bands)), layout='tight')
+    axes = figure.subplots(len(bands), squeeze=False)[:, 0]
+    for i, band in enumerate(bands):
+        axes[i].set_title(band)
+        _plot_histogram(axes[i], band, histogram[256 * i:256 * (i + 1)])
+    figure.savefig(path)
+
+
+def _plot_histogram(axes, band, channel_histogram):
+    from matplotlib.collections import PolyCollection
+    import numpy as np
+
+    # All bars in one collection, instead of an artist per bar, which is slow
+    heights = np.asarray(channel_histogram, dtype=float)
+    left = np.arange(256) - 0.4
+    right = left + 0.8
+    zeros = np.zeros(256)
+    bars = np.stack([
+        np.column_stack([left, zeros]),
+        np.column_stack([left, heights]),
+        np.column_stack([right, heights]),
+        np.column_stack([right, zeros]),
+    ], axis=1)
+
+    if band in 'RGB':
+        colors = np.zeros((256, 3))
+        colors[:, 'RGB'.index(band)] = np.arange(256) / 255
+    else:
+        colors = 'C0'
+    axes.add_collection(PolyCollection(bars, facecolors=colors,
+                                       edgecolors=colors, alpha=0.7))
+    axes.autoscale_view()
+
 
-    rs = [color[0] for color in colors]
-    gs = [color[1] for color in colors]
-    bs = [color[2] for color in colors]
+def check_first_palette_colors(colors):
+    """
+    Look for patterns in the first colors of the palettes of an animation's
+    frames, given as an array with a row of R, G and B values per frame.
+    """
+    import PIL.Image
 
     _log('Trying to find patterns in R values')
-    yield bytes(rs)
+    yield colors[:, 0].tobytes()
     _log('Trying to find patterns in G values')
-    yield bytes(gs)
+    yield colors[:, 1].tobytes()
     _log('Trying to find patterns in B values')
-    yield bytes(bs)
+    yield colors[:, 2].tobytes()
 
     _log('Creating image from first colors in palettes')
-    bytes_ = bytes(x for color in colors for x in color)
-    dimensions = _factorize(image.n_frames)
-    image = PIL.Image.frombytes('RGB', dimensions, bytes_)
+    dimensions = _factorize(len(colors))
+    image = PIL.Image.frombytes('RGB', dimensions, colors.tobytes())
     check_pixels(image)
 
 
+def _open(data):
+    import PIL.Image
+
+    # Unlike io.BytesIO, this doesn't copy memory-mapped input
+    return PIL.Image.open(io.BufferedReader(_BufferReader(data)))
+
+
+class _BufferReader(io.RawIOBase):
+    """Read-only file object on top of a buffer, without copying it."""
+
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self._data[self._position:self._position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        start = {
+            io.SEEK_SET: 0,
+            io.SEEK_CUR: self._position,
+            io.SEEK_END: len(self._data),
+        }[whence]
+        self._position = max(0, start + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
 def _factorize(n):
     ds = []
     for d in (2, 3, 5, 7, 11, 13, 17, 19):
@@ -123,13 +318,49 @@ def _factorize(n):
     return w, math.prod(ds)
 
 
+def _show(image, name):
+    if VISUALS == 'prompt':
+        image.show()
+    elif VISUALS == 'save':
+        path = os.path.join(OUTPUT_DIR, f'{name}.png')
+        _log(f'Saving image to {path}')
+        _render(image.save, path)
+
+
+def _render(function, *args):
+    """Write an artifact to disk in the background."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    global _renderer
+    if _renderer is None:
+        _renderer = ThreadPoolExecutor(max_workers=2,
+                                       thread_name_prefix='render')
+    _renderer.submit(function, *args).add_done_callback(_check_render)
+
+
+def _check_render(future):
+    if future.exception() is not None:
+        _log(f'Saving failed: {future.exception()!r}')
+
+
+def _wants(question):
+    if VISUALS == 'prompt':
+        return _prompt_bool(question)
+    return VISUALS == 'save'
+
+
 def _prompt_bool(question, default='no'):
     answer_to_value = {'yes': True, 'y': True, 'no': False, 'n': False}
     options = {'yes': 'Y/n', 'no': 'y/N'}[default]
 
     while True:
         _log(f'{question} [{options}] ', end='')
-        answer = input().lower()
+        try:
+            answer = input().lower()
+        except EOFError:
+            # E.g. in a worker process, which doesn't get a stdin
+            print()
+            return answer_to_value[default]
         if answer == '':
             answer = default
         try:
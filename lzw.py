@@ -0,0 +1,187 @@
+"""
+Decoder for the variable-length-code LZW compression of GIF image data.
+
+See:
+    https://www.w3.org/Graphics/GIF/spec-gif89a.txt (appendix F)
+
+Going through the codes one at a time takes about a microsecond per code in
+Python, so the decoding is vectorised with NumPy instead:
+
+ - Between clear codes, the size of a code only depends on how many codes
+   came before it, so all codes up to the next clear code are read at once.
+ - A code past the end code stands for the string of the code it was defined
+   after (its prefix), plus one byte (its suffix): the first byte of the
+   string of the code after that one. The lengths and first bytes of all
+   strings follow by pointer jumping along the prefixes.
+ - All of a string but its suffix is a copy of the string of its prefix,
+   which is one byte shorter, so the strings are written one length at a
+   time, all strings of that length at once.
+"""
+
+from collections import namedtuple
+
+import budget
+
+MAX_CODE_SIZE = 12
+MAX_CODES = 1 << MAX_CODE_SIZE
+
+# Number of 12-bit codes to read at once, once the string table is full
+CHUNK_SIZE = 1 << 12
+
+# pixels: the decoded pixels, up to n_pixels of them
+# excess: pixels decoded past n_pixels
+# trailing: data after the end-of-information code
+# complete: whether the end-of-information code was found (and no invalid
+# codes before it)
+Decoded = namedtuple('Decoded', 'pixels excess trailing complete')
+
+
+def decode(blocks, min_code_size, n_pixels):
+    """
+    Decode the LZW data in the iterable of data sub-blocks `blocks`, into
+    (at most) n_pixels color indices.
+    """
+    import numpy as np
+
+    assert 1 <= min_code_size <= 11, f'Bad LZW code size {min_code_size}'
+    end_code = (1 << min_code_size) + 1
+
+    data = b''.join(blocks)
+    codes, origins, end, complete = read_codes(data, min_code_size)
+    # Whatever follows the end of the image data: the whole bytes after the
+    # end code, and any further blocks
+    trailing = data[-(-end // 8):] if complete else b''
+
+    n_codes = len(codes)
+    pixels = bytearray(n_pixels)
+    if n_codes == 0:
+        return Decoded(pixels, b'', trailing, complete)
+
+    # The prefix of code end_code + 1 + i of a segment is the i-th code of
+    # that segment. Codes without one point to themselves.
+    indices = np.arange(n_codes)
+    defined = codes > end_code
+    prefixes = np.where(defined, origins + codes - end_code - 1, indices)
+    root = prefixes
+    depth = defined.astype(np.int64)
+    while True:
+        budget.checkpoint()
+        further = root[root]
+        if np.array_equal(further, root):
+            break
+        depth = depth + depth[root]
+        root = further
+    lengths = depth + 1
+    firsts = codes[root]
+    suffixes = np.where(defined,
+                        firsts[np.minimum(prefixes + 1, n_codes - 1)], codes)
+
+    n_output = int(lengths.sum())
+    budget.check_size(max(n_output - n_pixels, 0))
+    starts = np.cumsum(lengths) - lengths
+    output = np.empty(n_output, np.uint8)
+    output[starts + depth] = suffixes
+    # Strings by length, shortest first (as 16 bits, which NumPy sorts with a
+    # radix sort)
+    by_depth = np.argsort(depth.astype(np.int16), kind='stable')
+    bounds = np.cumsum(np.bincount(depth))
+    for length in range(1, len(bounds)):
+        budget.checkpoint()
+        strings = by_depth[bounds[length - 1]:bounds[length]]
+        if len(strings) == 0:
+            continue
+        offsets = np.arange(length)
+        output[starts[strings, np.newaxis] + offsets] = \
+            output[starts[prefixes[strings], np.newaxis] + offsets]
+
+    pixels[:min(n_output, n_pixels)] = output[:n_pixels].tobytes()
+    return Decoded(pixels, output[n_pixels:].tobytes(), trailing, complete)
+
+
+def read_codes(data, min_code_size):
+    """
+    Read the codes from data up to the end code, an invalid code, or the end
+    of data, leaving out clear codes.
+
+    Returns the codes, for every code the index of the first code after the
+    last clear code before it (where its segment starts), the bit offset
+    after the last code read, and whether that was the end code.
+    """
+    import numpy as np
+
+    clear_code = 1 << min_code_size
+    end_code = clear_code + 1
+    # The sizes of the codes of a segment, where they end relative to where
+    # it starts, their masks and the highest code valid at each: right after
+    # a clear code, only single bytes can follow, and after that any code up
+    # to the one being defined. The first chunk of codes is read up to where
+    # the string table is full, after which all codes are 12 bits.
+    steps = np.arange(MAX_CODES - end_code + 1)
+    sizes = np.minimum(np.maximum(_bit_lengths(end_code + steps),
+                                  min_code_size + 1), MAX_CODE_SIZE)
+    sizes[0] = min_code_size + 1
+    highest = np.minimum(end_code + steps, MAX_CODES)
+    highest[0] = clear_code - 1
+    first_chunk = _chunk_layout(sizes, highest)
+    full_chunk = _chunk_layout(np.full(CHUNK_SIZE, MAX_CODE_SIZE),
+                               np.full(CHUNK_SIZE, MAX_CODES))
+
+    # The 3 bytes from every byte on, which hold any code starting in it
+    padded = np.zeros(len(data) + 2, np.uint32)
+    padded[:len(data)] = np.frombuffer(data, np.uint8)
+    windows = padded[:-2] | padded[1:-1] << 8 | padded[2:] << 16
+    n_bits = 8 * len(data)
+
+    codes = []
+    origins = []
+    n_codes = 0
+    bit = 0
+    step = 0
+    while True:
+        budget.checkpoint()
+        sizes, ends, masks, highest = first_chunk if step == 0 \
+            else full_chunk
+        ends = bit + ends
+        n_read = int(np.searchsorted(ends, n_bits, side='right'))
+        ends = ends[:n_read]
+        starts = ends - sizes[:n_read]
+        chunk = (windows[starts >> 3] >> (starts & 7).astype(np.uint32)
+                 & masks[:n_read])
+        stops = np.flatnonzero((chunk == clear_code) | (chunk == end_code)
+                               | (chunk > highest[:n_read]))
+        n_valid = stops[0] if len(stops) > 0 else len(chunk)
+        codes.append(chunk[:n_valid])
+        origins.append(np.full(n_valid, n_codes - step))
+        n_codes += n_valid
+
+        if len(stops) > 0:
+            bit = int(ends[n_valid])
+            code = chunk[n_valid]
+            if code == clear_code:
+                step = 0
+                continue
+            complete = code == end_code
+            break
+        if n_read < len(sizes):
+            # Out of data
+            complete = False
+            break
+        bit = int(ends[-1])
+        step += len(chunk)
+
+    return (np.concatenate(codes).astype(np.int64),
+            np.concatenate(origins).astype(np.int64), bit, complete)
+
+
+def _chunk_layout(sizes, highest):
+    """Precompute what reading a chunk of codes of these sizes needs."""
+    import numpy as np
+
+    return (sizes, np.cumsum(sizes),
+            ((1 << sizes) - 1).astype(np.uint32), highest)
+
+
+def _bit_lengths(values):
+    import numpy as np
+
+    return np.frexp(values)[1]
@@ -1,5 +1,15 @@
+"""
+Morse code in bitstreams, where 1 means "on" and 0 means "off", at any speed.
+
+Bitstreams extracted from images or audio-like data are often scaled by some
+factor, so instead of assuming one bit per time unit, we run-length encode the
+bits and infer the unit from the lengths of the runs.
+"""
+
 from collections import Counter
-import re
+
+import budget
+import tracing
 
 ALPHABET = {
     '.-': 'a',
@@ -67,24 +77,157 @@ ALPHABET = {
 }
 
 
-def try_decode(bit_str):
-    counter = Counter(len(m) for m in re.findall(r'0+', bit_str))
-    if len(counter) <= 3:
-        print(f'Morse code possible, histogram: {counter}')
-        decoded = decode(bit_str)
-        print(f'Morse decoded: "{decoded}"')
-        yield decoded.encode('ascii')
+# Number of bits that are run-length encoded at a time
+CHUNK_SIZE = 1 << 20
+
+# How far a run's length may be off from a multiple of the unit (relatively)
+TOLERANCE = 0.25
+# Fraction of runs that has to fit the timing for it to be morse code
+MIN_FIT = 0.9
+
+# Symbols for: dot, dash, gap within a letter, between letters, between words
+SYMBOLS = ('.', '-', '', ' ', ' / ')
+
+
+def try_decode(bits):
+    with tracing.step('morse.run_histograms', len(bits)):
+        marks, spaces = run_histograms(bits)
+    if len(spaces) == 0:
+        return
 
+    unit = estimate_unit(marks, spaces)
+    fit = timing_fit(marks, spaces, unit)
+    if fit < MIN_FIT:
+        return
 
-def decode(bit_str):
-    return ' '.join(decode_word(word) for word in bit_str.split('0000000'))
+    print(f'Morse code possible: {unit:.2f} bits per unit,'
+          f' {fit:.0%} of the runs fit. Marks: {dict(marks)},'
+          f' spaces: {dict(spaces)}')
+    decoded = decode(bits, unit)
+    print(f'Morse decoded: "{decoded[:200]}"'
+          + ('<snip>' if len(decoded) > 200 else ''))
+    yield decoded.encode('ascii')
 
 
-def decode_word(bit_str):
-    return ''.join(decode_letter(letter) for letter in bit_str.split('000'))
+def decode(bits, unit):
+    return ''.join(iter_decode(bits, unit))
 
 
-def decode_letter(bit_str):
-    morse = ''.join({'1': '.', '111': '-'}.get(sign, '?')
-                    for sign in bit_str.split('0'))
+def iter_decode(bits, unit):
+    """Decode bits with the given unit length, streaming letter by letter."""
+    import numpy as np
+
+    symbols = np.array(SYMBOLS, dtype=object)
+    partial_letter = ''
+    for values, lengths in iter_runs(bits):
+        units = lengths / unit
+        codes = np.where(
+            values == 1,
+            np.where(units < 2, 0, 1),
+            np.select([units < 2, units < 5], [2, 3], 4),
+        )
+        letters = (partial_letter + ''.join(symbols[codes])).split(' ')
+        # The last letter may continue in the next chunk
+        partial_letter = letters.pop()
+        yield from map(decode_letter, letters)
+    if partial_letter:
+        yield decode_letter(partial_letter)
+
+
+def decode_letter(morse):
+    if morse == '/':
+        return ' '
     return ALPHABET.get(morse, '<?>')
+
+
+def estimate_unit(marks, spaces):
+    """
+    Estimate the length of a time unit as the mean length of the shortest
+    cluster of runs: dots and gaps within letters are one unit long.
+    """
+    lengths = marks + spaces
+    shortest = min(lengths)
+    cluster = {length: count for length, count in lengths.items()
+               if length < 2 * shortest}
+    return (sum(length * count for length, count in cluster.items())
+            / sum(cluster.values()))
+
+
+def timing_fit(marks, spaces, unit):
+    """Return the fraction of runs that is about 1, 3 or (for gaps) 7+ units."""
+    def fits(length, multiples):
+        return any(abs(length / unit - multiple) <= TOLERANCE * multiple
+                   for multiple in multiples)
+
+    n_fitting = (
+        sum(count for length, count in marks.items() if fits(length, (1, 3)))
+        + sum(count for length, count in spaces.items()
+              if fits(length, (1, 3)) or length / unit >= 7 * (1 - TOLERANCE))
+    )
+    return n_fitting / (sum(marks.values()) + sum(spaces.values()))
+
+
+def run_histograms(bits):
+    """Count the lengths of the runs of 1s (marks) and of 0s (spaces)."""
+    import numpy as np
+
+    marks = Counter()
+    spaces = Counter()
+    for values, lengths in iter_runs(bits):
+        for histogram, value in ((marks, 1), (spaces, 0)):
+            unique, counts = np.unique(lengths[values == value],
+                                       return_counts=True)
+            histogram.update(dict(zip(unique.tolist(), counts.tolist())))
+    return marks, spaces
+
+
+def iter_runs(bits, chunk_size=CHUNK_SIZE):
+    """
+    Run-length encode bits, which is either a string of '0' and '1'
+    characters (anything else is ignored) or an array of 0s and 1s.
+
+    Yields an array of run values and one of run lengths per chunk of input,
+    leaving out the silence (0s) at the start and at the end.
+    """
+    import numpy as np
+
+    started = False
+    pending = None  # The last run so far, which may continue in a next chunk
+    for start in range(0, len(bits), chunk_size):
+        budget.checkpoint()
+        chunk = _as_array(bits[start:start + chunk_size])
+        if len(chunk) == 0:
+            continue
+
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(chunk)) + 1))
+        lengths = np.diff(np.append(starts, len(chunk)))
+        values = chunk[starts]
+        if pending is not None:
+            pending_value, pending_length = pending
+            if pending_value == values[0]:
+                lengths[0] += pending_length
+            else:
+                values = np.concatenate(([pending_value], values))
+                lengths = np.concatenate(([pending_length], lengths))
+
+        pending = values[-1], lengths[-1]
+        values = values[:-1]
+        lengths = lengths[:-1]
+        if not started and len(values) > 0:
+            started = True
+            if values[0] == 0:
+                values = values[1:]
+                lengths = lengths[1:]
+        yield values, lengths
+
+    if pending is not None and pending[0] == 1:
+        yield np.array(pending[:1]), np.array(pending[1:])
+
+
+def _as_array(bits):
+    import numpy as np
+
+    if isinstance(bits, str):
+        chars = np.frombuffer(bits.encode('ascii', 'ignore'), np.uint8)
+        return chars[(chars == ord('0')) | (chars == ord('1'))] - ord('0')
+    return np.asarray(bits, dtype=np.uint8)
@@ -4,21 +4,82 @@ See:
     https://www.w3.org/TR/PNG/
 """
 
+from collections import namedtuple
+import os
+import zlib
+
+import budget
+import decoders
+import image
+import tracing
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Number of channels per colour type
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# Passes of Adam7 interlacing: first column and row, and steps between them
+ADAM7_PASSES = ((0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4),
+                (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2))
+
+# Maximum number of bytes of image data to decompress at once
+WINDOW_SIZE = 1 << 16
+
+# Number of threads to check CRCs in (zlib releases the GIL while it's busy),
+# for images with more than CRC_THREADING_THRESHOLD bytes in their chunks
+CRC_THREADS = min(4, os.cpu_count() or 1)
+CRC_THREADING_THRESHOLD = 1 << 24
+
+# A chunk in the index: its type, the offset and length of its data, and the
+# CRC stored after it
+Chunk = namedtuple('Chunk', 'type offset length crc')
+
+
+@decoders.register('png', magic=(SIGNATURE,))
+def try_decode(data, _profile):
+    return image.try_decode(data, check_normal_format)
+
 
 def check_normal_format(data):
+    """
+    Walk the chunks, yielding anything hidden in the structure: image data
+    past what the dimensions need, data past the end of the compressed image
+    data, data past the IEND chunk, and the CRCs that don't match their chunk.
+    """
+    # Parse straight from the (possibly memory-mapped) buffer, without copies
+    data = memoryview(data)
     file_header = data[:8]
-    assert file_header == b'\x89PNG\r\n\x1a\n'
+    assert file_header == SIGNATURE
+
+    chunks, offset = index_chunks(data, 8)
+    # First chunk has to be the IHDR chunk, and the last one the IEND chunk
+    assert chunks[0].type == b'IHDR'
+    assert chunks[-1].type == b'IEND'
+    assert chunks[-1].length == 0
+    width, height, bit_depth, colour_type, interlace_method = \
+        parse_ihdr_data(read_chunk(data, chunks[0]))
+
+    with tracing.step('png.crc', offset):
+        mismatches = verify_crcs(data, chunks)
+    if len(mismatches) > 0:
+        _log(f'{len(mismatches)} chunks with a wrong CRC:'
+             f' {", ".join(chunk.type.decode() for chunk in mismatches)}')
 
-    ihdr_type, ihdr_data, offset = parse_chunk(data, 8)
-    # First chunk has to be the IHDR chunk
-    assert ihdr_type == b'IHDR'
-    width, height, bit_depth = parse_ihdr_data(ihdr_data)
+    image_data = ImageDataStream(expected_image_data_size(
+        width, height, bit_depth * CHANNELS[colour_type], interlace_method
+    ))
+    idat_chunks = [chunk for chunk in chunks if chunk.type == b'IDAT']
+    # We look elsewhere at actual pixel values with Pillow, but check the
+    # compressed stream here
+    with tracing.step('png.idat', sum(chunk.length for chunk in idat_chunks)):
+        for chunk in idat_chunks:
+            image_data.feed(read_chunk(data, chunk))
 
-    chunk_type, chunk_data, offset = parse_chunk(data, offset)
-    while chunk_type != b'IEND':
-        match chunk_type:
+    for chunk in chunks[1:-1]:
+        chunk_data = read_chunk(data, chunk)
+        match chunk.type:
             case b'IDAT':
-                # We look elsewhere at actual pixel values with Pillow
+                # Handled above
                 pass
             case b'eXIf':
                 _log('eXIf chunk: Exif data detected. Run exiftool.')
@@ -33,10 +94,9 @@ def check_normal_format(data):
                 assert unit == 1  # Metres
                 # _log(f'pHYs chunk: Pixels per meter: {ppu_x}x{ppu_y}.')
             case b'iTXt':
-                assert chunk_data.startswith(
+                assert chunk_data[:22] == \
                     b'XML:com.adobe.xmp\x00\x00\x00\x00\x00'
-                )
-                _log(f'iTXt chunk: {chunk_data[22:].decode()}')
+                _log(f'iTXt chunk: {bytes(chunk_data[22:]).decode()}')
             case b'gAMA':
                 assert len(chunk_data) == 4
                 # gamma = parse_int(chunk_data)
@@ -45,29 +105,81 @@ def check_normal_format(data):
                 # _log('cHRM chunk.')
                 pass
             case b'bKGD':
-                bg_colour = chunk_data
+                bg_colour = bytes(chunk_data)
                 _log(f'bKGD chunk: Explicit background colour set: {bg_colour}')
             case b'tIME':
                 # _log('tIME chunk.')
                 pass
             case b'tEXt':
-                _log(f'tEXt chunk: {chunk_data.decode()}')
+                _log(f'tEXt chunk: {bytes(chunk_data).decode()}')
             case _:
-                _log(f'Unknown chunk type {chunk_type}')
+                _log(f'Unknown chunk type {chunk.type}')
+
+    yield from image_data.finish()
+    if len(mismatches) > 0:
+        # Data may be hidden in the CRCs
+        yield b''.join(chunk.crc.to_bytes(4, 'big') for chunk in mismatches)
+    if offset < len(data):
+        _log(f'{len(data) - offset} bytes of data after the IEND chunk.')
+        yield bytes(data[offset:])
+
+
+def index_chunks(data, offset):
+    """
+    Index the chunks from offset up to and including the IEND chunk, in one
+    pass that only reads their headers and CRCs. Returns the index and the
+    offset after the last chunk.
+    """
+    chunks = []
+    while offset + 12 <= len(data):
+        length = parse_int(data[offset:offset + 4])
+        chunk_type = bytes(data[offset + 4:offset + 8])
+        end = offset + 8 + length
+        assert end + 4 <= len(data), f'Truncated {chunk_type} chunk'
+        chunks.append(Chunk(chunk_type, offset + 8, length,
+                            parse_int(data[end:end + 4])))
+        offset = end + 4
+        if chunk_type == b'IEND':
+            break
+    return chunks, offset
 
-        chunk_type, chunk_data, offset = parse_chunk(data, offset)
 
-    # After last chunk
-    assert len(chunk_data) == 0
-    assert len(data) == offset
+def read_chunk(data, chunk):
+    return data[chunk.offset:chunk.offset + chunk.length]
 
 
-def parse_chunk(data, offset):
-    length = parse_int(data[offset:offset + 4])
-    chunk_type = data[offset + 4:offset + 8]
-    chunk_data = data[offset + 8:offset + 8 + length]
-    # NB: data may be hidden in CRC. We ignore it here.
-    return chunk_type, chunk_data, offset + 8 + length + 4
+def verify_crcs(data, chunks, threads=CRC_THREADS):
+    """Return the chunks whose CRC doesn't match their type and data."""
+    def crcs(chunks):
+        # The CRC covers the chunk type, which comes right before the data
+        return [zlib.crc32(data[chunk.offset - 4:chunk.offset + chunk.length])
+                for chunk in chunks]
+
+    total_length = sum(chunk.length for chunk in chunks)
+    if threads <= 1 or total_length < CRC_THREADING_THRESHOLD:
+        computed = crcs(chunks)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(threads) as pool:
+            batches = pool.map(crcs, _batches(chunks, total_length // threads))
+            computed = [crc for batch in batches for crc in batch]
+    return [chunk for chunk, crc in zip(chunks, computed) if crc != chunk.crc]
+
+
+def _batches(chunks, batch_length):
+    """Split chunks into consecutive batches of about batch_length bytes."""
+    batch = []
+    length = 0
+    for chunk in chunks:
+        batch.append(chunk)
+        length += chunk.length
+        if length >= batch_length:
+            yield batch
+            batch = []
+            length = 0
+    if len(batch) > 0:
+        yield batch
 
 
 def parse_ihdr_data(data):
@@ -89,10 +201,93 @@ def parse_ihdr_data(data):
     assert compression_method == 0
     filter_method = parse_int(data[11:12])
     assert filter_method == 0
-    interlace_method = parse_int(data[13:14])
-    assert interlace_method == 0
+    interlace_method = parse_int(data[12:13])
+    assert interlace_method in (0, 1)
+    if interlace_method == 1:
+        _log('Adam7 interlaced.')
     assert len(data) == 13
-    return width, height, bit_depth
+    return width, height, bit_depth, colour_type, interlace_method
+
+
+def expected_image_data_size(width, height, bits_per_pixel,
+                             interlace_method):
+    """Return the size of the uncompressed image data, with filter bytes."""
+    def size(width, height):
+        if width == 0 or height == 0:
+            return 0
+        return height * (1 + (width * bits_per_pixel + 7) // 8)
+
+    if interlace_method == 0:
+        return size(width, height)
+    return sum(size(-(-(width - x) // dx), -(-(height - y) // dy))
+               for x, y, dx, dy in ADAM7_PASSES)
+
+
+class ImageDataStream:
+    """
+    Decompresses the data of all IDAT chunks as the one zlib stream they are,
+    a window at a time, so the scanlines are never all in memory at once.
+
+    Only the amount of image data is kept, together with anything that
+    doesn't belong to the image: decompressed data past the expected size,
+    and compressed data past the end of the zlib stream.
+    """
+
+    def __init__(self, expected_size):
+        self.expected_size = expected_size
+        self.size = 0
+        self.decompressor = zlib.decompressobj()
+        self.broken = False
+        self.excess = []
+        self.excess_size = 0
+        self.trailing = []
+
+    def feed(self, data):
+        if self.broken:
+            return
+        if self.decompressor.eof:
+            self.trailing.append(bytes(data))
+            return
+        try:
+            while True:
+                budget.checkpoint()
+                output = self.decompressor.decompress(data, WINDOW_SIZE)
+                self._count(output)
+                data = self.decompressor.unconsumed_tail
+                if self.decompressor.eof \
+                        or (len(data) == 0 and len(output) < WINDOW_SIZE):
+                    break
+        except zlib.error as e:
+            _log(f'Corrupt image data: {e}')
+            self.broken = True
+            return
+        if self.decompressor.eof and len(self.decompressor.unused_data) > 0:
+            self.trailing.append(self.decompressor.unused_data)
+
+    def _count(self, output):
+        if self.size + len(output) > self.expected_size:
+            excess = output[max(0, self.expected_size - self.size):]
+            self.excess_size += len(excess)
+            budget.check_size(self.excess_size)
+            self.excess.append(excess)
+        self.size += len(output)
+
+    def finish(self):
+        """Log what's off about the image data, and yield what's hidden."""
+        if not self.broken and not self.decompressor.eof:
+            _log('Image data ends before the end of its zlib stream.')
+        if self.size != self.expected_size:
+            _log(f'{self.size} bytes of image data, while the dimensions'
+                 f' need {self.expected_size}.')
+        if len(self.excess) > 0:
+            _log(f'{self.excess_size} bytes of image data past the last'
+                 f' scanline.')
+            yield b''.join(self.excess)
+        if len(self.trailing) > 0:
+            trailing = b''.join(self.trailing)
+            _log(f'{len(trailing)} bytes of data after the zlib stream in'
+                 f' the IDAT chunks.')
+            yield trailing
 
 
 def parse_int(data):
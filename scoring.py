@@ -0,0 +1,104 @@
+"""
+Cheap plausibility scores for blobs, to decide which ones to decode first.
+
+A score is between 0 (garbage) and 1 (certainly worth a look), and is computed
+from the blob's profile (see alphabets.profile), so it costs no extra pass.
+"""
+
+import math
+
+import decoders
+
+# Relative frequencies of letters in English text
+ENGLISH_FREQUENCIES = {
+    'a': .0817, 'b': .0149, 'c': .0278, 'd': .0425, 'e': .1270, 'f': .0223,
+    'g': .0202, 'h': .0609, 'i': .0697, 'j': .0015, 'k': .0077, 'l': .0403,
+    'm': .0241, 'n': .0675, 'o': .0751, 'p': .0193, 'q': .0010, 'r': .0599,
+    's': .0633, 't': .0906, 'u': .0276, 'v': .0098, 'w': .0236, 'x': .0015,
+    'y': .0197, 'z': .0007,
+}
+
+# Blobs we have a structural decoder for
+MAGIC_SCORE = 1.0
+BINARY_SCORE = 0.9
+
+# Two-valued blobs only score as bitstrings if they're this long, and their
+# rarer symbol makes up at least this much of them. Anything else with two
+# values, like packed bits that are mostly zero, is scored like any blob.
+MIN_BITSTRING_LENGTH = 16
+MIN_BITSTRING_BALANCE = 0.1
+
+# Hidden data tends to be at the start of a blob, e.g. in the LSBs of an
+# image, so we also score the start on its own.
+PREFIX_LENGTH = 64
+
+PRINTABLE = frozenset(range(ord(' '), ord('~') + 1)) | {ord('\t'), 10, 13}
+
+
+def score(data, profile, prefix_profile=None):
+    if decoders.has_magic(data):
+        return MAGIC_SCORE
+    if is_bitstring(profile):
+        return BINARY_SCORE
+    text_score = score_text(profile)
+    if prefix_profile is not None:
+        text_score = max(text_score, score_text(prefix_profile))
+    return text_score
+
+
+def is_bitstring(profile):
+    """
+    Whether a blob looks like bits written out as two symbols: printable ones
+    like '0' and '1' or '.' and '-', or the byte values 0 and 1.
+    """
+    if profile.n_unique != 2 or profile.length < MIN_BITSTRING_LENGTH:
+        return False
+    symbols = (profile.min, profile.max)
+    if symbols != (0, 1) and not all(symbol in PRINTABLE
+                                     for symbol in symbols):
+        return False
+    return min(profile.histogram[symbol] for symbol in symbols) \
+        >= MIN_BITSTRING_BALANCE * profile.length
+
+
+def score_text(profile):
+    """Score how much a blob looks like (encoded) text."""
+    if profile.length == 0:
+        return 0.0
+    return (0.5 * printable_ratio(profile)
+            + 0.3 * englishness(profile)
+            + 0.2 * (1 - relative_entropy(profile)))
+
+
+def printable_ratio(profile):
+    return sum(profile.histogram[value] for value in PRINTABLE) \
+        / profile.length
+
+
+def relative_entropy(profile):
+    """Shannon entropy, relative to the maximum for a blob of its length."""
+    max_entropy = math.log2(min(256, profile.length))
+    if max_entropy == 0:
+        return 0.0
+    entropy = -sum(count / profile.length * math.log2(count / profile.length)
+                   for count in profile.histogram if count > 0)
+    return entropy / max_entropy
+
+
+def englishness(profile):
+    """
+    Map the chi-squared statistic of the letter frequencies against English
+    to a score between 0 and 1, weighed by how much of the blob is letters.
+    """
+    counts = {letter: profile.count(letter) + profile.count(letter.upper())
+              for letter in ENGLISH_FREQUENCIES}
+    n_letters = sum(counts.values())
+    if n_letters == 0:
+        return 0.0
+    chi_squared = sum(
+        (counts[letter] - n_letters * frequency) ** 2
+        / (n_letters * frequency)
+        for letter, frequency in ENGLISH_FREQUENCIES.items()
+    )
+    letter_ratio = n_letters / profile.length
+    return math.exp(-chi_squared / n_letters) * min(1, 1.25 * letter_ratio)
@@ -0,0 +1,287 @@
+"""
+Statistical attacks on least-significant-bit embedding in images:
+
+ - the chi-square attack, which finds the pairs of values (2k, 2k + 1) that
+   embedding makes about equally common, and
+ - RS analysis, which estimates how many LSBs were changed from how flipping
+   LSBs changes the smoothness of small groups of pixels.
+
+See:
+    A. Westfeld, A. Pfitzmann, "Attacks on Steganographic Systems" (1999)
+    J. Fridrich, M. Goljan, R. Du, "Reliable Detection of LSB Steganography
+    in Color and Grayscale Images" (2001)
+
+Both are computed for every tile of a sliding window over the image, which
+gives a heatmap of where a message is likely to be. The statistics they need
+add up, so they're counted once per cell of CELL by CELL pixels, and a tile is
+2 by 2 cells, overlapping its neighbours by one cell. Cells are counted per
+band of BAND_CELL_ROWS rows of cells, in threads, and only the last row of
+cells of a band is kept for the tiles it shares with the next. That keeps
+memory bounded for very large images.
+"""
+
+from collections import namedtuple
+import math
+import os
+
+import budget
+
+CELL = 32
+BAND_CELL_ROWS = 8
+THREADS = min(4, os.cpu_count() or 1)
+
+# Pairs of values need to be this common (together) in a tile to count in the
+# chi-square test; the approximation it relies on is poor for rare ones
+MIN_PAIR_COUNT = 10
+
+# channel: the band analysed
+# chi_square: per tile, the probability that its LSBs carry a message
+# rs: per tile, the estimated fraction of its pixels that carry message bits
+# rate: the estimated fraction of pixels of the whole channel that do
+# payload: the estimated size in bytes of the message in the channel
+Analysis = namedtuple('Analysis', 'channel chi_square rs rate payload')
+
+
+def analyse(image, threads=THREADS):
+    """
+    Run both attacks on every band of a Pillow image but alpha, and return an
+    Analysis per band. Returns None if the image is smaller than a tile.
+    """
+    import numpy as np
+
+    if image.mode not in ('L', 'P', 'LA', 'RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    image.load()
+    bands = image.getbands()
+    channels = [i for i, band in enumerate(bands) if band != 'A']
+    width, height = image.size
+    # Only whole cells are analysed
+    n_rows, n_columns = height // CELL, width // CELL
+    if n_rows < 2 or n_columns < 2:
+        return None
+
+    def band_statistics(row):
+        box = (0, row * CELL, n_columns * CELL,
+               min(row + BAND_CELL_ROWS, n_rows) * CELL)
+        pixels = np.asarray(image.crop(box))
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, np.newaxis]
+        return cell_statistics(pixels[:, :, channels])
+
+    if threads > 1 and n_rows > BAND_CELL_ROWS:
+        from concurrent.futures import ThreadPoolExecutor
+
+        pool = ThreadPoolExecutor(threads)
+        map_bands = pool.map
+    else:
+        pool = None
+        map_bands = map
+
+    chi_square = []
+    rs = []
+    totals = 0
+    previous = None
+    try:
+        # A few bands at a time, so that only those are in memory
+        group_rows = BAND_CELL_ROWS * threads
+        for group in range(0, n_rows, group_rows):
+            budget.checkpoint()
+            rows = range(group, min(group + group_rows, n_rows),
+                         BAND_CELL_ROWS)
+            for histograms, counts in map_bands(band_statistics, rows):
+                totals = totals + counts.sum(axis=(0, 1))
+                if previous is not None:
+                    histograms = np.concatenate([previous[0], histograms])
+                    counts = np.concatenate([previous[1], counts])
+                previous = histograms[-1:], counts[-1:]
+                if len(histograms) > 1:
+                    chi_square.append(
+                        chi_square_probability(_tiles(histograms)))
+                    rs.append(rs_rate(_tiles(counts)))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    chi_square = np.concatenate(chi_square)
+    rs = np.concatenate(rs)
+    rates = rs_rate(totals)
+    n_pixels = n_rows * n_columns * CELL * CELL
+    return [Analysis(bands[channel], chi_square[:, :, i], rs[:, :, i],
+                     float(rates[i]), int(rates[i] * n_pixels / 8))
+            for i, channel in enumerate(channels)]
+
+
+def cell_statistics(pixels):
+    """
+    Count what both attacks need for every cell of an array of rows by
+    columns by channels of 8-bit values, whose sides are multiples of CELL.
+
+    Returns an array of the histograms of every cell (cell rows by cell
+    columns by channels by 256), and one of the RS group counts of every
+    cell (by 4, see rs_groups).
+    """
+    import numpy as np
+
+    height, width, n_channels = pixels.shape
+    n_rows, n_columns = height // CELL, width // CELL
+
+    # Histograms of all cells of a channel in one bincount, of the values
+    # offset by 256 times the index of their cell
+    rows, columns = np.ogrid[0:height, 0:width]
+    offsets = ((rows // CELL * n_columns + columns // CELL) * 256).astype(
+        np.int32)
+    histograms = np.stack([
+        np.bincount((offsets + pixels[:, :, i]).ravel(),
+                    minlength=n_rows * n_columns * 256).reshape(
+                        n_rows, n_columns, 256)
+        for i in range(n_channels)
+    ], axis=2)
+
+    # Groups of 4 pixels along the rows, as 4 planes of the first, second,
+    # etc. pixel of every group, channels first
+    planes = pixels.reshape(height, width // 4, 4, n_channels).transpose(
+        2, 3, 0, 1).astype(np.int16)
+    counts = np.stack([
+        # Add up the groups of every cell
+        groups.reshape(n_channels, n_rows, CELL, n_columns, CELL // 4).sum(
+            axis=4, dtype=np.int32).sum(axis=2)
+        for groups in rs_groups(*planes)
+    ], axis=-1).transpose(1, 2, 0, 3)
+    return histograms.astype(np.int32), counts
+
+
+def rs_groups(x0, x1, x2, x3):
+    """
+    Classify every group of 4 pixels (x0, x1, x2, x3) as regular (1),
+    singular (-1) or neither (0), for the mask (0, 1, 1, 0) and its negative,
+    before and after flipping all LSBs. A group is regular if flipping (with
+    the mask) makes it less smooth, and singular if it makes it smoother.
+
+    Returns 4 arrays: for the mask and for the negative mask, for the groups
+    as they are, then with flipped LSBs. Their sums are the numbers of regular
+    minus singular groups, which is all the estimate needs.
+    """
+    import numpy as np
+
+    def smoothness(x0, x1, x2, x3):
+        return abs(x1 - x0) + abs(x2 - x1) + abs(x3 - x2)
+
+    def flip(x):
+        # 2k <-> 2k + 1
+        return x ^ 1
+
+    def flip_negative(x):
+        # 2k - 1 <-> 2k
+        return ((x + 1) ^ 1) - 1
+
+    groups = []
+    for x0, x1, x2, x3 in ((x0, x1, x2, x3),
+                           (flip(x0), flip(x1), flip(x2), flip(x3))):
+        before = smoothness(x0, x1, x2, x3)
+        for f in (flip, flip_negative):
+            groups.append(np.sign(smoothness(x0, f(x1), f(x2), x3) - before))
+    return groups
+
+
+def _tiles(cells):
+    """Add up the statistics of every 2 by 2 cells."""
+    return cells[:-1, :-1] + cells[:-1, 1:] + cells[1:, :-1] + cells[1:, 1:]
+
+
+def chi_square_probability(histograms):
+    """
+    The probability that the values counted in every histogram (along the
+    last axis) had their LSBs replaced by message bits, i.e. that the values
+    of every pair (2k, 2k + 1) are as common as each other by chance.
+    """
+    import numpy as np
+
+    even = histograms[..., 0::2].astype(float)
+    odd = histograms[..., 1::2]
+    pairs = even + odd
+    valid = pairs >= MIN_PAIR_COUNT
+    # If both values of a pair are equally likely, the count of one is
+    # binomial, and this is a chi-square statistic with a degree of freedom
+    # per pair. (Westfeld's form, sum((even - pairs / 2)^2 / (pairs / 2)), is
+    # half of that.)
+    statistic = np.where(valid, (even - odd) ** 2
+                         / np.where(valid, pairs, 1), 0).sum(axis=-1)
+    degrees = valid.sum(axis=-1)
+    return np.where(degrees > 0, _upper_tail(statistic, degrees), 0)
+
+
+def _upper_tail(statistic, degrees):
+    """
+    The probability of a chi-square statistic at least this large, using the
+    Wilson-Hilferty approximation by a normal distribution.
+    """
+    import numpy as np
+
+    degrees = np.maximum(degrees, 1)
+    variance = 2 / (9 * degrees)
+    z = ((statistic / degrees) ** (1 / 3) - (1 - variance)) / np.sqrt(variance)
+    erfc = np.frompyfunc(math.erfc, 1, 1)
+    return erfc(z / math.sqrt(2)).astype(float) / 2
+
+
+def rs_rate(counts):
+    """
+    Estimate, from the RS group counts (along the last axis, see rs_groups),
+    the fraction of pixels that carry message bits.
+
+    With d the number of regular minus singular groups for the mask, before
+    (0) and after (1) flipping all LSBs, and e the same for the negative mask,
+    the rate is x / (x - 1/2) for the root x of smallest magnitude of
+
+        2 (d1 + d0) x^2 + (e0 - e1 - d1 - 3 d0) x + d0 - e0 = 0
+    """
+    import numpy as np
+
+    d0, e0, d1, e1 = np.moveaxis(np.asarray(counts, float), -1, 0)
+    a = 2 * (d1 + d0)
+    b = e0 - e1 - d1 - 3 * d0
+    c = d0 - e0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        root = np.sqrt(np.maximum(b ** 2 - 4 * a * c, 0))
+        roots = np.stack([(-b + root) / (2 * a), (-b - root) / (2 * a)])
+        x = np.where(a != 0,
+                     np.take_along_axis(roots,
+                                        np.abs(roots).argmin(axis=0)[None],
+                                        axis=0)[0],
+                     -c / b)
+        rate = x / (x - 0.5)
+    return np.clip(np.nan_to_num(rate), 0, 1)
+
+
+def region(values, threshold=0.5):
+    """
+    The box (left, top, right, bottom) in pixels around the rows of tiles
+    whose mean value is over threshold, and the columns of tiles that are
+    within those rows, or None if there are none. Averaging over rows and
+    columns keeps single noisy tiles from stretching the box.
+    """
+    import numpy as np
+
+    rows = np.nonzero(values.mean(axis=1) > threshold)[0]
+    if len(rows) == 0:
+        return None
+    columns = np.nonzero(values[rows.min():rows.max() + 1].mean(axis=0)
+                         > threshold)[0]
+    if len(columns) == 0:
+        return None
+    # Tile (i, j) covers cells i and i + 1 down, j and j + 1 across
+    return (int(columns.min()) * CELL, int(rows.min()) * CELL,
+            (int(columns.max()) + 2) * CELL, (int(rows.max()) + 2) * CELL)
+
+
+def heatmap(values):
+    """An image of per-tile values between 0 and 1, at about image scale."""
+    import numpy as np
+    import PIL.Image
+
+    tiles = PIL.Image.fromarray((np.clip(values, 0, 1) * 255).astype(
+        np.uint8))
+    # Tiles are one cell apart
+    return tiles.resize((tiles.width * CELL, tiles.height * CELL),
+                        PIL.Image.NEAREST)
@@ -0,0 +1,63 @@
+import random
+
+import pytest
+
+import base58
+
+
+def _decode_digit_by_digit(s, alphabet):
+    """The original implementation, one digit and one byte at a time."""
+    acc = 0
+    for char in s:
+        acc = acc * 58 + alphabet.index(char)
+    result = []
+    while acc > 0:
+        acc, mod = divmod(acc, 256)
+        result.append(mod)
+    return bytes(reversed(result))
+
+
+@pytest.mark.parametrize('length', [1, 9, 10, 11, 57, 1000, 20_000])
+def test_matches_digit_by_digit(length):
+    rng = random.Random(length)
+    # Leading zero digits are what the original dropped
+    s = rng.choice(base58.BITCOIN_ALPHABET[1:]) + ''.join(
+        rng.choices(base58.BITCOIN_ALPHABET, k=length - 1))
+    assert base58.decode(s) == \
+        _decode_digit_by_digit(s, base58.BITCOIN_ALPHABET)
+
+
+def test_leading_zero_digits_are_zero_bytes():
+    assert base58.decode('111') == bytes(3)
+    assert base58.decode('11ZiCa') == b'\x00\x00abc'
+    assert base58.decode('rrp', 'RIPPLE') == b'\x00\x00\x01'
+
+
+def test_flickr_alphabet():
+    # Lowercase before uppercase
+    assert base58.decode('11yHcz', 'FLICKR') == b'\x00\x00abc'
+    s = ''.join(random.Random(0).choices(base58.BITCOIN_ALPHABET, k=100))
+    flickr = s.translate(str.maketrans(base58.BITCOIN_ALPHABET,
+                                       base58.FLICKR_ALPHABET))
+    assert base58.decode(flickr, 'FLICKR') == base58.decode(s)
+
+
+def test_empty():
+    assert base58.decode('') == b''
+
+
+@pytest.mark.parametrize('s', ['0', 'abcO', 'Il', 'é'])
+def test_invalid_characters(s):
+    with pytest.raises(ValueError):
+        base58.decode(s)
+
+
+def test_fft_multiplication():
+    rng = random.Random(0)
+    for bits in [base58.FFT_MIN_BITS, 100_000, 1_000_000]:
+        a = rng.getrandbits(bits)
+        b = rng.getrandbits(bits // 3 + base58.FFT_MIN_BITS)
+        assert base58.multiply(a, b) == a * b
+    # All ones gives the biggest sums of byte products
+    a = (1 << 1_000_000) - 1
+    assert base58.multiply(a, a) == a * a
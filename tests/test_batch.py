@@ -0,0 +1,88 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import batch
+import decoders
+import image
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+@pytest.fixture(autouse=True)
+def no_visuals(monkeypatch):
+    # As in the workers
+    monkeypatch.setattr(image, 'VISUALS', 'skip')
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    (tmp_path / 'nested').mkdir()
+    shutil.copy(os.path.join(EXAMPLES, 'flag.png'), tmp_path)
+    shutil.copy(os.path.join(EXAMPLES, 'b32.txt'), tmp_path / 'nested')
+    with open(os.path.join(EXAMPLES, 'flag.png'), 'rb') as f:
+        (tmp_path / 'corrupt.png').write_bytes(f.read(300) + b'not a PNG')
+    # A dangling symlink can't be read, even by root
+    (tmp_path / 'unreadable').symlink_to(tmp_path / 'missing')
+    return tmp_path
+
+
+def _by_file(records):
+    files = {}
+    for record in records:
+        files.setdefault(record['file'], []).append(record)
+    return files
+
+
+def test_scan_directory(corpus):
+    files = _by_file(batch.scan(batch.iter_paths([str(corpus)]), jobs=2,
+                                window=2))
+    paths = sorted(batch.iter_paths([str(corpus)]))
+    assert paths == sorted(str(corpus / name) for name in (
+        'corrupt.png', 'flag.png', 'nested/b32.txt', 'unreadable'))
+    # Every file's records, as if it was scanned on its own
+    for path, records in files.items():
+        assert records == batch.scan_file(path)
+
+    unreadable, = files[str(corpus / 'unreadable')]
+    assert unreadable['error'].startswith('FileNotFoundError')
+    assert all('error' not in record
+               for path, records in files.items()
+               if not path.endswith('unreadable')
+               for record in records)
+    assert len(files[str(corpus / 'flag.png')]) > 0
+    assert str(corpus / 'corrupt.png') not in files
+    assert [record['chain'] for record in files[str(corpus / 'nested'
+                                                 / 'b32.txt')]] == \
+        [['text'], ['text', 'text'], ['text', 'text', 'text']]
+
+
+def test_one_json_line_per_record(corpus, capsys):
+    batch.main([str(corpus), '--jobs', '2'])
+    lines = capsys.readouterr().out.splitlines()
+    records = [json.loads(line) for line in lines]
+    assert sorted(map(json.dumps, records)) == sorted(
+        json.dumps(record)
+        for path in batch.iter_paths([str(corpus)])
+        for record in batch.scan_file(path))
+
+
+def test_default_budget_is_applied(monkeypatch, tmp_path):
+    path = tmp_path / 'seed'
+    path.write_bytes(b'seed')
+    monkeypatch.setattr(decoders, 'route', lambda data, alphabet, **_: [
+        decoders.Decoder('grow', lambda data, profile: [bytes(data) + b'+'],
+                         1, None)])
+    records = batch.scan_file(str(path))
+    truncated, = [record for record in records if 'truncated' in record]
+    assert truncated['truncated'] == 'depth'
+    assert len(truncated['chain']) == batch.DEFAULT_BUDGET.depth + 1
+
+    limits = []
+    monkeypatch.setattr(batch, 'scan', lambda paths, jobs, window, visuals,
+                        output_dir, budget, decode_frames:
+                        limits.append(budget) or [])
+    batch.main([str(path)])
+    assert limits == [batch.DEFAULT_BUDGET]
@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+import budget
+import decoders
+import detect
+
+
+@pytest.fixture
+def tree(monkeypatch):
+    """Make every blob decode to itself plus 'a', and itself plus 'b'."""
+    def grow(data, profile):
+        yield data + b'a'
+        yield data + b'b'
+
+    monkeypatch.setattr(decoders, 'route', lambda data, alphabet, **_: [
+        decoders.Decoder('grow', grow, 1, None),
+    ])
+
+
+def _truncations(data, limits):
+    truncations = []
+    detect.keep_decoding(data, limits=limits,
+                         on_truncation=truncations.append)
+    return truncations
+
+
+def test_node_limit_stops_the_search(tree):
+    truncations = _truncations(b'start', budget.Budget(nodes=5))
+    assert [truncation.reason for truncation in truncations] == ['nodes']
+    assert 'blobs dropped' in truncations[0].detail
+
+
+def test_depth_limit(tree):
+    truncations = _truncations(b'start', budget.Budget(depth=2))
+    # Both blobs derived from each of the 4 blobs at depth 2
+    assert len(truncations) == 8
+    assert all(truncation.reason == 'depth' and len(truncation.chain) == 3
+               for truncation in truncations)
+
+
+def test_time_limit(tree):
+    truncations = _truncations(b'start', budget.Budget(seconds=0))
+    assert [truncation.reason for truncation in truncations] == ['time']
+
+
+def test_blob_size_limit(tree):
+    truncations = _truncations(b'start', budget.Budget(blob_size=7))
+    # The first blob of 8 bytes cancels the decoder, for each of the 4
+    # blobs of 7 bytes
+    assert len(truncations) == 4
+    assert all(truncation.reason == 'decoder' and len(truncation.chain) == 3
+               for truncation in truncations)
+
+
+def test_decoder_time_limit(monkeypatch):
+    def busy(data, profile):
+        yield b'partial result'
+        while True:
+            budget.checkpoint()
+
+    monkeypatch.setattr(decoders, 'route', lambda data, alphabet, **_: [
+        decoders.Decoder('busy', busy, 1, None),
+    ])
+    truncations = _truncations(b'start',
+                               budget.Budget(decoder_seconds=0.01))
+    # Of the input, and of the partial result
+    assert [(truncation.reason, truncation.chain)
+            for truncation in truncations] == [('decoder', ('busy',)),
+                                               ('decoder', ('busy', 'busy'))]
+
+
+def test_limits_nest_and_restore():
+    with budget.limit(seconds=60, blob_size=10):
+        budget.check_size(10)
+        with budget.limit(seconds=0, blob_size=100):
+            time.sleep(0.001)
+            with pytest.raises(budget.BudgetExceeded):
+                budget.checkpoint()
+            # The outer size limit is tighter
+            with pytest.raises(budget.BudgetExceeded):
+                budget.check_size(11)
+        budget.checkpoint()
+    budget.check_size(1 << 40)
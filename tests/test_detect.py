@@ -0,0 +1,124 @@
+import contextlib
+import io
+import multiprocessing
+import os
+
+import pytest
+
+import decoders
+import detect
+import image
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+def test_failing_decoder_is_skipped(monkeypatch):
+    def failing(data, profile):
+        yield b'partial'
+        raise NotImplementedError
+
+    def working(data, profile):
+        yield b'whole'
+
+    monkeypatch.setattr(decoders, 'route', lambda data, alphabet: [
+        decoders.Decoder('failing', failing, 1, None),
+        decoders.Decoder('working', working, 1, None),
+    ])
+    assert list(detect.decode(b'input')) == [('failing', b'partial'),
+                                             ('working', b'whole')]
+
+
+def test_octal_looking_blobs_do_not_end_the_run(capsys):
+    # Packs into b'777', among others
+    detect.keep_decoding(b'00110111' * 3)
+    assert 'Octal values.' in capsys.readouterr().out
+
+
+def test_magic_bytes_alone_fall_back_to_the_alphabet_decoders(capsys):
+    list(detect.decode(b'GIF89a c2VjcmV0IG1lc3NhZ2UK'))
+    out = capsys.readouterr().out
+    assert 'Failed to decode as gif' in out
+    assert 'Trying to decode as text.' in out
+
+
+def test_truncated_image_falls_back_to_the_alphabet_decoders(capsys):
+    with open(os.path.join(EXAMPLES, 'flag.png'), 'rb') as f:
+        truncated = f.read(60)
+    list(detect.decode(truncated))
+    assert 'Trying to decode as text.' in capsys.readouterr().out
+
+
+def test_transposition_table_evicts_the_least_recently_seen():
+    seen = detect.TranspositionTable(max_entries=2)
+    assert seen.add(b'x')
+    assert seen.add(b'y')
+    assert not seen.add(b'x')
+    assert seen.add(b'z')
+    assert b'x' in seen and b'z' in seen and b'y' not in seen
+    assert len(seen) == 2
+
+
+def test_blob_reached_two_ways_is_handled_once(monkeypatch):
+    def decoder(name, derive):
+        return decoders.Decoder(name, lambda data, profile: derive(data),
+                                1, None)
+
+    # Both swapping and reversing 'ab' give 'ba', which decodes to nothing
+    monkeypatch.setattr(decoders, 'route', lambda data, alphabet, **_: [
+        decoder('swap', lambda data: [data[1::-1] + data[2:]]),
+        decoder('reverse', lambda data: [data[::-1]]),
+    ] if data == b'ab' else [])
+    findings = []
+    seen = detect.keep_decoding(
+        b'ab', min_score=0,
+        on_finding=lambda data, chain, score: findings.append((data, chain)))
+    assert findings == [(b'ba', ('swap',))]
+    ba = detect.digest(b'ba')
+    assert seen.provenance(ba) == ('swap',)
+    assert seen.parents(ba) == [(detect.digest(b'ab'), 'swap'),
+                                (detect.digest(b'ab'), 'reverse')]
+
+
+def _findings(data, **options):
+    findings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        detect.keep_decoding(data, on_finding=lambda data, chain, score:
+                             findings.append((bytes(data), chain, score)),
+                             **options)
+    return findings
+
+
+@pytest.mark.parametrize('name', sorted(os.listdir(EXAMPLES)))
+def test_jobs_find_the_same(monkeypatch, name):
+    monkeypatch.setattr(image, 'VISUALS', 'skip')
+    with open(os.path.join(EXAMPLES, name), 'rb') as f:
+        data = f.read()
+    serial = _findings(data)
+    # In the same order with a window of 1, in some order with any other
+    assert _findings(data, jobs=2, window=1) == serial
+    assert sorted(_findings(data, jobs=2)) == sorted(serial)
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                    reason='workers need to be forked with the patches')
+def test_worker_exception_is_reported(monkeypatch, capsys):
+    def route(data, alphabet, **_):
+        return [decoders.Decoder('grow', lambda data, profile: [data + b'+'],
+                                 1, None)] if len(data) < 8 else []
+
+    decode = detect.decode
+
+    def failing_decode(data, *args):
+        if data == b'data+':
+            raise MemoryError('out of memory')
+        return decode(data, *args)
+
+    monkeypatch.setattr(decoders, 'route', route)
+    monkeypatch.setattr(detect, 'decode', failing_decode)
+    findings = []
+    detect.keep_decoding(b'data', jobs=2, min_score=0,
+                         on_finding=lambda data, chain, score:
+                         findings.append(data))
+    assert findings == [b'data+']
+    assert 'Failed to decode in a worker: MemoryError: out of memory' in \
+        capsys.readouterr().out
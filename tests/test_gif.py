@@ -0,0 +1,104 @@
+import io
+import os
+
+import numpy as np
+import PIL.Image
+import pytest
+
+import gif
+import image
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+@pytest.fixture(autouse=True)
+def no_visuals(monkeypatch):
+    monkeypatch.setattr(image, 'VISUALS', 'skip')
+
+
+def _frames(data):
+    walk = gif.check_normal_format(memoryview(data))
+    while True:
+        try:
+            next(walk)
+        except StopIteration as stop:
+            return stop.value
+
+
+def _gif(pixels, **options):
+    frame = PIL.Image.fromarray(pixels, 'P')
+    frame.putpalette(list(range(256)) * 3)
+    buffer = io.BytesIO()
+    frame.save(buffer, 'GIF', **options)
+    return buffer.getvalue()
+
+
+def test_example_matches_pillow():
+    with open(os.path.join(EXAMPLES, 'flag.gif'), 'rb') as f:
+        data = f.read()
+    pixels, decoded = gif.decode_frame(memoryview(data), _frames(data)[0])
+    assert decoded.complete
+    assert np.array_equal(pixels, np.asarray(PIL.Image.open(io.BytesIO(data))))
+
+
+@pytest.mark.parametrize('interlace', [False, True])
+def test_noise_and_runs_match_pillow(interlace):
+    rng = np.random.default_rng(0)
+    # Noise fills the string table fast, runs make long strings
+    pixels = np.concatenate([
+        rng.integers(0, 256, (100, 120)),
+        np.repeat(rng.integers(0, 4, (100, 6)), 20, axis=1),
+    ]).astype(np.uint8)
+    data = _gif(pixels, interlace=interlace)
+    frame, = _frames(data)
+    decoded, _ = gif.decode_frame(memoryview(data), frame)
+    assert np.array_equal(decoded, pixels)
+    assert np.array_equal(decoded,
+                          np.asarray(PIL.Image.open(io.BytesIO(data))))
+
+
+def test_data_after_end_code_is_yielded():
+    data = _gif(np.zeros((8, 8), np.uint8))
+    frame, = _frames(data)
+    # Append a sub-block after the image data
+    end = data.rindex(b'\x00;')
+    data = data[:end] + b'\x06hidden' + data[end:]
+    assert list(gif.check_image_data(memoryview(data), [frame])) == \
+        [b'hidden']
+
+
+def _hide_in_frame(data, frame):
+    """Add a sub-block after the image data of frame."""
+    offset = frame.data_offset + 1
+    while data[offset] != 0:
+        offset += data[offset] + 1
+    return data[:offset] + b'\x06hidden' + data[offset:]
+
+
+def _animation(n_frames):
+    rng = np.random.default_rng(0)
+    frames = [PIL.Image.fromarray(rng.integers(0, 4, (8, 8), np.uint8), 'P')
+              for _ in range(n_frames)]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, 'GIF', save_all=True, append_images=frames[1:])
+    return buffer.getvalue()
+
+
+def _findings(data):
+    return list(gif.check_normal_format(memoryview(data)))
+
+
+def test_data_hidden_in_a_later_frame_is_yielded():
+    data = _animation(4)
+    frames = _frames(data)
+    assert len(frames) == 4
+    data = _hide_in_frame(data, frames[2])
+    assert b'hidden' in _findings(data)
+
+
+def test_decoded_frames_can_be_capped(monkeypatch, capsys):
+    data = _animation(4)
+    data = _hide_in_frame(data, _frames(data)[2])
+    monkeypatch.setattr(image, 'DECODE_FRAMES', 2)
+    assert b'hidden' not in _findings(data)
+    assert 'first 2 of 4 frames' in capsys.readouterr().out
@@ -0,0 +1,56 @@
+import numpy as np
+import PIL.Image
+import pytest
+
+import image
+
+PAYLOAD = b'the flag is hidden in the least significant bits'
+
+
+def _streams(pixels):
+    mode = 'RGB' if pixels.ndim == 3 else 'L'
+    return list(image.extract_bit_planes(PIL.Image.fromarray(pixels, mode)))
+
+
+def _hide(values, bitorder):
+    """Put PAYLOAD in the LSBs of the first values of a flat array."""
+    bits = np.unpackbits(np.frombuffer(PAYLOAD, np.uint8), bitorder=bitorder)
+    values[:len(bits)] = values[:len(bits)] & 0xfe | bits
+
+
+def _random(shape):
+    return np.random.default_rng(0).integers(0, 256, shape, np.uint8)
+
+
+@pytest.mark.parametrize('bitorder', ['big', 'little'])
+def test_payload_in_one_channel(bitorder):
+    pixels = _random((32, 48, 3))
+    green = pixels[:, :, 1].ravel()
+    _hide(green, bitorder)
+    pixels[:, :, 1] = green.reshape(32, 48)
+    assert any(PAYLOAD in stream for stream in _streams(pixels))
+
+
+@pytest.mark.parametrize('bitorder', ['big', 'little'])
+@pytest.mark.parametrize('by_columns', [False, True])
+def test_payload_in_interleaved_channels(bitorder, by_columns):
+    pixels = _random((32, 48, 3))
+    if by_columns:
+        scanned = np.ascontiguousarray(pixels.transpose(1, 0, 2))
+    else:
+        scanned = pixels
+    values = scanned.ravel()
+    _hide(values, bitorder)
+    scanned = values.reshape(scanned.shape)
+    pixels = scanned.transpose(1, 0, 2) if by_columns else scanned
+    assert any(PAYLOAD in stream
+               for stream in _streams(np.ascontiguousarray(pixels)))
+
+
+def test_constant_planes_are_skipped():
+    # Bit 0 is random, bit 1 all zeros and bits 2 to 7 all ones
+    pixels = _random((32, 48)) & 1 | 0b11111100
+    streams = _streams(pixels)
+    # Only bit 0, by rows and by columns, in both bit orders
+    assert len(streams) == 4
+    assert all(len(stream) == 32 * 48 // 8 for stream in streams)
@@ -0,0 +1,102 @@
+import io
+import math
+
+import numpy as np
+import PIL.Image
+import pytest
+
+import budget
+import jpeg
+
+
+def _jpeg(mode, **options):
+    rng = np.random.default_rng(0)
+    rows, columns = np.mgrid[0:48, 0:64]
+    pixels = (rows * 2 + columns + rng.integers(0, 40, (48, 64))).astype(
+        np.uint8)
+    if mode == 'RGB':
+        pixels = np.stack([pixels, pixels[::-1], 255 - pixels], axis=-1)
+    buffer = io.BytesIO()
+    PIL.Image.fromarray(pixels, mode).save(buffer, 'JPEG', **options)
+    return buffer.getvalue()
+
+
+def _parse(data):
+    data = memoryview(data)
+    state = jpeg.State()
+    jpeg.parse_image(data, 0, jpeg.index_markers(data), state)
+    return state
+
+
+def _idct(grid, table):
+    """Dequantize and inverse-DCT a grid of blocks into 8-bit samples."""
+    quantization = np.empty(64)
+    quantization[list(jpeg.ZIGZAG)] = table
+    scale = np.array([math.sqrt(1 / 8)] + [math.sqrt(2 / 8)] * 7)
+    x = np.arange(8)
+    basis = scale[:, np.newaxis] * np.cos(
+        (2 * x + 1) * x[:, np.newaxis] * math.pi / 16)
+    blocks = grid * quantization.reshape(8, 8)
+    samples = basis.T @ blocks @ basis + 128
+    rows, columns = grid.shape[:2]
+    return samples.transpose(0, 2, 1, 3).reshape(rows * 8, columns * 8)
+
+
+@pytest.mark.parametrize('mode', ['L', 'RGB'])
+def test_coefficients_match_pillow(mode):
+    data = _jpeg(mode, quality=90)
+    state = _parse(data)
+    luma = state.frame.components[0]
+    grid = jpeg.coefficient_blocks(state)[luma.id]
+    samples = _idct(grid, state.quantization_tables[
+        luma.quantization_table])[:48, :64]
+
+    reference = PIL.Image.open(io.BytesIO(data))
+    # Decode to YCbCr without converting to RGB, to compare luma
+    reference.draft('YCbCr' if mode == 'RGB' else 'L', reference.size)
+    expected = np.asarray(reference, float)
+    if expected.ndim == 3:
+        expected = expected[:, :, 0]
+    assert np.abs(samples - expected).max() <= 2
+
+
+def test_progressive_is_not_decoded():
+    state = _parse(_jpeg('L', progressive=True))
+    assert len(state.coefficients) == 0
+
+
+def test_lsb_streams_of_the_ac_coefficients():
+    state = _parse(_jpeg('L', quality=90))
+    blocks = np.frombuffer(state.coefficients, np.int16).reshape(-1, 64)
+    ac = blocks[:, 1:]
+    jsteg, nonzero = jpeg.check_coefficients(state)
+    assert len(jsteg) == -(-np.count_nonzero((ac != 0) & (ac != 1)) // 8)
+    assert np.array_equal(np.unpackbits(np.frombuffer(nonzero, np.uint8))
+                          [:np.count_nonzero(ac)], ac[ac != 0] & 1)
+
+
+def _corrupt_ecs(data):
+    """Overwrite the start of the entropy-coded data with ones."""
+    sos = data.index(b'\xff\xda')
+    start = sos + 2 + int.from_bytes(data[sos + 2:sos + 4], 'big')
+    # All ones is never a complete code, and 0xff has to be stuffed
+    return data[:start] + b'\xff\x00' * 4 + data[start + 8:]
+
+
+def test_invalid_huffman_code(capsys):
+    state = _parse(_corrupt_ecs(_jpeg('L', quality=90)))
+    assert not state.decodable
+    assert 'invalid Huffman code' in capsys.readouterr().out
+
+
+def test_coefficient_decoding_is_capped(monkeypatch, capsys):
+    monkeypatch.setattr(jpeg, 'COEFFICIENT_SECONDS', 0)
+    state = _parse(_jpeg('L', quality=90))
+    assert not state.decodable
+    assert 'Stopped decoding coefficients' in capsys.readouterr().out
+
+
+def test_running_out_of_time_still_stops_the_run():
+    with pytest.raises(budget.BudgetExceeded):
+        with budget.limit(seconds=0):
+            _parse(_jpeg('L', quality=90))
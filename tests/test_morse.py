@@ -0,0 +1,70 @@
+import functools
+import random
+
+import numpy as np
+import pytest
+
+import morse
+
+TEXT = 'sos at 10 pm'
+
+
+def _encode(text, lengths):
+    """
+    Encode text as a string of bits, with the run lengths from `lengths`:
+    a function of the number of units, dots and gaps within letters being 1.
+    """
+    codes = {letter: code for code, letter in morse.ALPHABET.items()}
+    runs = []
+    for word in text.split(' '):
+        for letter in word:
+            for symbol in codes[letter]:
+                runs += [('1', 1 if symbol == '.' else 3), ('0', 1)]
+            runs[-1] = ('0', 3)
+        runs[-1] = ('0', 7)
+    # Silence at the start and the end
+    runs = [('0', 10)] + runs[:-1] + [('0', 10)]
+    return ''.join(value * lengths(units) for value, units in runs)
+
+
+@pytest.mark.parametrize('unit', [1, 2, 3, 5, 7])
+def test_any_unit(unit):
+    bits = _encode(TEXT, lambda units: unit * units)
+    assert list(morse.try_decode(bits)) == [TEXT.encode()]
+
+
+def test_irregular_run_lengths():
+    rng = random.Random(0)
+    bits = _encode(TEXT, lambda units: 8 * units + rng.randint(-1, 1))
+    assert list(morse.try_decode(bits)) == [TEXT.encode()]
+
+
+def test_no_morse_in_noise():
+    rng = random.Random(0)
+    bits = ''.join(rng.choice('01') for _ in range(10_000))
+    assert list(morse.try_decode(bits)) == []
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 16, 1000])
+def test_input_split_across_chunks(monkeypatch, chunk_size):
+    bits = _encode(TEXT, lambda units: 5 * units)
+
+    def runs(chunk_size):
+        values, lengths = zip(*morse.iter_runs(bits, chunk_size))
+        return np.concatenate(values), np.concatenate(lengths)
+
+    whole = runs(len(bits))
+    chunked = runs(chunk_size)
+    assert np.array_equal(chunked[0], whole[0])
+    assert np.array_equal(chunked[1], whole[1])
+    # Letters and words that straddle chunks
+    monkeypatch.setattr(morse, 'iter_runs',
+                        functools.partial(morse.iter_runs,
+                                          chunk_size=chunk_size))
+    assert morse.decode(bits, 5) == TEXT
+
+
+def test_array_input():
+    bits = _encode(TEXT, lambda units: 3 * units)
+    array = np.frombuffer(bits.encode(), np.uint8) - ord('0')
+    assert morse.decode(array, 3) == morse.decode(bits, 3) == TEXT
@@ -0,0 +1,38 @@
+import io
+import zlib
+
+import pytest
+
+import image
+import png
+
+
+def _chunk(chunk_type, data, crc=None):
+    if crc is None:
+        crc = zlib.crc32(chunk_type + data).to_bytes(4, 'big')
+    return len(data).to_bytes(4, 'big') + chunk_type + data + crc
+
+
+def _png(*chunks):
+    import PIL.Image
+
+    buffer = io.BytesIO()
+    PIL.Image.new('L', (4, 4)).save(buffer, 'PNG')
+    plain = buffer.getvalue()
+    idat = plain.index(b'IDAT') - 4
+    iend = plain.index(b'IEND') - 4
+    before, after = chunks
+    return plain[:idat] + before + plain[idat:iend] + after + plain[iend:]
+
+
+@pytest.mark.parametrize('where', ['before IDAT', 'after IDAT'])
+def test_forged_crc_is_yielded(monkeypatch, where):
+    monkeypatch.setattr(image, 'VISUALS', 'skip')
+    forged = _chunk(b'tEXt', b'Comment\x00nothing to see', crc=b'flag')
+    data = _png(forged, b'') if where == 'before IDAT' else _png(b'', forged)
+    assert b'flag' in list(png.try_decode(data, None))
+
+
+def test_broken_png_without_findings_fails():
+    with pytest.raises(Exception):
+        list(png.try_decode(png.SIGNATURE + b'\x00' * 40, None))
@@ -0,0 +1,28 @@
+import alphabets
+import scoring
+
+
+def _score(data):
+    return scoring.score(data, alphabets.profile(data),
+                         alphabets.profile(data[:scoring.PREFIX_LENGTH]))
+
+
+def test_bitstrings_score_as_binary():
+    assert _score(b'0111001101100101') == scoring.BINARY_SCORE
+    assert _score(b'.-..-.-.---.-...') == scoring.BINARY_SCORE
+    assert _score(bytes([0, 1, 1, 0] * 4)) == scoring.BINARY_SCORE
+
+
+def test_two_valued_blobs_that_are_not_bitstrings():
+    # Too short, too unbalanced, and not bits written out
+    for data in (b'0110', b'0' * 63 + b'1', b'\xff\xbf' * 8):
+        assert _score(data) < scoring.BINARY_SCORE
+
+
+def test_packed_bits_rank_below_plaintext():
+    for packed in (b'\x00\x00\x00\x10\x00', b'\xff\xff\xff\xbf\xff'):
+        assert _score(packed) < _score(b'the secret message')
+
+
+def test_magic_bytes_score_highest():
+    assert _score(b'\x89PNG\r\n\x1a\n') == scoring.MAGIC_SCORE
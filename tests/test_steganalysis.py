@@ -0,0 +1,68 @@
+import numpy as np
+import PIL.Image
+import pytest
+
+import steganalysis
+
+
+def _smooth(size=256, seed=0):
+    rng = np.random.default_rng(seed)
+    rows, columns = np.mgrid[0:size, 0:size]
+    pixels = (96 + 60 * np.sin(rows / 40) + 50 * np.cos(columns / 30)
+              + rng.normal(0, 2, (size, size)))
+    return np.clip(np.round(pixels), 0, 255).astype(np.uint8)
+
+
+def _embed(pixels, rate, seed=1):
+    """Replace the LSBs of a random `rate` of the pixels by random bits."""
+    rng = np.random.default_rng(seed)
+    pixels = pixels.copy()
+    carrying = rng.random(pixels.shape) < rate
+    bits = rng.integers(0, 2, np.count_nonzero(carrying), np.uint8)
+    pixels[carrying] = pixels[carrying] & 0xfe | bits
+    return pixels
+
+
+@pytest.mark.parametrize('rate', [0, 0.25, 0.5, 1])
+def test_rs_estimates_the_embedding_rate(rate):
+    analysis, = steganalysis.analyse(
+        PIL.Image.fromarray(_embed(_smooth(), rate)))
+    assert analysis.channel == 'L'
+    assert analysis.rate == pytest.approx(rate, abs=0.1)
+    assert analysis.payload == pytest.approx(rate * 256 * 256 / 8,
+                                             abs=0.1 * 256 * 256 / 8)
+
+
+def test_rs_finds_where_the_message_is():
+    pixels = _smooth()
+    pixels[:128] = _embed(pixels[:128], 1)
+    analysis, = steganalysis.analyse(PIL.Image.fromarray(pixels))
+    # Tiles are 2 cells high, so the one across the border is half embedded
+    assert steganalysis.region(analysis.rs) == (0, 0, 256, 160)
+
+
+def test_chi_square_separates_embedded_tiles():
+    # Only even values, so that pairs are as uneven as they get without a
+    # message
+    pixels = _smooth() & 0xfe
+    pixels[:128] = _embed(pixels[:128], 1)
+    analysis, = steganalysis.analyse(PIL.Image.fromarray(pixels))
+    # Tiles 0-2 are all embedded, 4 and on not at all
+    assert analysis.chi_square[:3].mean() > 0.2
+    assert analysis.chi_square[4:].max() < 0.01
+
+
+def test_bands_and_threads_do_not_change_the_result(monkeypatch):
+    image = PIL.Image.fromarray(_embed(_smooth(), 0.5)).convert('RGB')
+    whole = steganalysis.analyse(image, threads=1)
+    monkeypatch.setattr(steganalysis, 'BAND_CELL_ROWS', 2)
+    banded = steganalysis.analyse(image, threads=3)
+    assert [analysis.channel for analysis in banded] == ['R', 'G', 'B']
+    for expected, actual in zip(whole, banded):
+        assert np.allclose(expected.chi_square, actual.chi_square)
+        assert np.allclose(expected.rs, actual.rs)
+        assert expected.rate == pytest.approx(actual.rate)
+
+
+def test_too_small_for_a_tile():
+    assert steganalysis.analyse(PIL.Image.new('L', (63, 100))) is None
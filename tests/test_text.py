@@ -0,0 +1,20 @@
+import text
+
+
+def test_octal_values_separated_by_whitespace():
+    encoded = ' '.join(f'{byte:o}' for byte in b'secret')
+    assert list(text.try_decode_text(encoded)) == [b'secret']
+
+
+def test_octal_digits_run_together():
+    encoded = ''.join(f'{byte:03o}' for byte in b'secret')
+    assert list(text.decode_octal(encoded)) == [b'secret']
+
+
+def test_octal_that_is_not_bytes_is_skipped():
+    assert list(text.try_decode_text('7')) == []
+    assert list(text.decode_octal('777')) == []
+
+
+def test_odd_length_hex_is_skipped():
+    assert list(text.try_decode_text('abc')) == []
@@ -0,0 +1,80 @@
+from collections import defaultdict
+import io
+import json
+import os
+
+import pytest
+
+import detect
+import image
+import tracing
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+@pytest.fixture(autouse=True)
+def no_visuals(monkeypatch):
+    monkeypatch.setattr(image, 'VISUALS', 'skip')
+
+
+def _run(hook, jobs=1):
+    with open(os.path.join(EXAMPLES, 'flag.png'), 'rb') as f:
+        data = f.read()
+    tracing.add_hook(hook)
+    try:
+        detect.keep_decoding(data, jobs=jobs)
+    finally:
+        tracing.remove_hook(hook)
+
+
+def test_json_lines():
+    file = io.StringIO()
+    trace = tracing.JsonLinesTrace(file)
+    _run(trace)
+    trace.close()
+    spans = [json.loads(line) for line in file.getvalue().splitlines()]
+    assert len(spans) > 0
+    assert all(set(span) == set(tracing.Span._fields) for span in spans)
+    assert {'png', 'image.steganalysis'} <= {span['name'] for span in spans}
+    assert all(span['start'] <= span['end'] for span in spans)
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_chrome_trace_events_nest(jobs):
+    file = io.StringIO()
+    trace = tracing.ChromeTrace(file)
+    _run(trace, jobs)
+    trace.close()
+    events = json.loads(file.getvalue())['traceEvents']
+    assert len(events) > 0
+
+    threads = defaultdict(list)
+    for event in events:
+        assert event['ph'] == 'X'
+        assert event['dur'] >= 0
+        threads[event['pid'], event['tid']].append(event)
+    for thread in threads.values():
+        # Every event has to end before the one it's within does
+        open_ends = []
+        for event in sorted(thread, key=lambda e: (e['ts'], -e['dur'])):
+            while open_ends and open_ends[-1] <= event['ts']:
+                open_ends.pop()
+            end = event['ts'] + event['dur']
+            # (Give or take the precision of microseconds since the epoch)
+            assert not open_ends or end <= open_ends[-1] + 1, event
+            open_ends.append(end)
+
+
+def test_profile():
+    profile = tracing.Profile()
+    _run(profile)
+    header, *rows = profile.table()
+    assert header.split() == ['name', 'calls', 'wall', 's', 'cpu', 's', 'MB',
+                              'in', 'MB', 'out', 'children', 'depth']
+    names = [row.split()[0] for row in rows]
+    assert 'png' in names and 'image.steganalysis' in names
+    # Slowest first
+    wall = [float(row.split()[2]) for row in rows]
+    assert wall == sorted(wall, reverse=True)
+    calls, *_ = profile.totals['png']
+    assert calls == 1
@@ -2,19 +2,28 @@ import base64
 import binascii
 from itertools import zip_longest
 
+import alphabets
 import base58
+import decoders
 import morse
 
 
-def try_decode_bytes(data):
-    data = data.strip()
+@decoders.register('text', alphabet='any')
+def try_decode_bytes(data, profile=None):
+    stripped = bytes(data).strip()
+    if len(stripped) == 0:
+        return
+    if profile is None or len(stripped) != len(data):
+        profile = alphabets.profile(stripped)
+    data = stripped
 
     if data.isascii():
         decoded = data.decode('ascii')
         _log('Valid ASCII.')
-        yield from try_decode_text(decoded)
+        yield from try_decode_text(decoded, profile)
         _log('Trying reversed.')
-        yield from try_decode_text(decoded[::-1])
+        # Reversing doesn't change which characters there are
+        yield from try_decode_text(decoded[::-1], profile)
 
     else:
         if len(data) % 4 == 0:
@@ -58,44 +67,51 @@ def try_decode_bytes(data):
             yield from try_decode_text(decoded)
 
 
-def try_decode_text(text):
-    is_normal = all(' ' <= c <= '~' or ord(c) in (0, 4, 10, 13) for c in text)
+def try_decode_text(text, profile=None):
+    """
+    Try the decodings that fit the characters in text, as found by its
+    `profile` (computed if not given), ignoring whitespace for most of them.
+    """
+    if profile is None:
+        profile = alphabets.profile(text.encode('utf-8', 'surrogatepass'))
+
+    is_normal = profile.is_in(alphabets.NORMAL)
     _log(f'{"Normal" if is_normal else "Weird"}'
-         f' {"ASCII" if text.isascii() else "non-ASCII"}'
+         f' {"ASCII" if profile.max < 0x80 else "non-ASCII"}'
          ' text:'
          f' "{pprint(text)}"')
 
-    sanitised = ''.join(text.lower().split())
-
-    if all('0' <= c <= '1' for c in sanitised):
+    if profile.is_in(alphabets.BINARY):
         _log('Binary values or morse code.')
+        sanitised = ''.join(text.split())
         yield bytes(int(''.join(bits), 2)
                     for bits in grouper(sanitised, 8, '0'))
         yield from morse.try_decode(text)
-    elif all('0' <= c <= '7' for c in sanitised):
+    elif profile.is_in(alphabets.OCTAL):
         _log('Octal values.')
-        raise NotImplementedError
-    elif all('0' <= c <= '9' or 'a' <= c <= 'f' for c in sanitised):
+        yield from decode_octal(text)
+    elif profile.is_in(alphabets.HEX):
         _log('Hexadecimal values.')
-        yield bytes.fromhex(text)
-    elif all('2' <= c <= '7' or 'A' <= c <= 'Z' or c == '='
-             for c in sanitised):
+        try:
+            yield bytes.fromhex(text)
+        except ValueError:
+            _log('Not hex-decodable.')
+    elif profile.is_in(alphabets.BASE32):
         try:
             decoded = base64.b32decode(text)
             _log(f'Base32-decoded: {pprint(decoded)}')
             yield decoded
         except binascii.Error:
             _log('Not base32-decodable.')
-    elif all('0' <= c <= '9' or 'a' <= c <= 'z' or c in '=/+'
-             for c in sanitised):
-        if not any(c in '0OlI+/' for c in text):
-            decoded = base58.decode(text, 'BTC')
-            _log(f'Base58-decoded (BTC): {pprint(decoded)}')
-            yield decoded
-
-            decoded = base58.decode(text, 'RIPPLE')
-            _log(f'Base58-decoded (RIPPLE): {pprint(decoded)}')
-            yield decoded
+    elif profile.is_in(alphabets.BASE64):
+        if profile.is_in(alphabets.BASE58):
+            for alphabet in base58.ALPHABETS:
+                try:
+                    decoded = base58.decode(text, alphabet)
+                    _log(f'Base58-decoded ({alphabet}): {pprint(decoded)}')
+                    yield decoded
+                except ValueError:
+                    _log(f'Not base58-decodable ({alphabet}).')
 
             try:
                 decoded = base64.b64decode(text)
@@ -106,11 +122,11 @@ def try_decode_text(text):
         else:
             try:
                 decoded = base64.b64decode(text)
-                _log(f'Base85-decoded: {pprint(decoded)}')
+                _log(f'Base64-decoded: {pprint(decoded)}')
                 yield decoded
             except binascii.Error:
                 _log('Not base64-decodable.')
-    elif all('!' <= c <= 'u' or c == '~' for c in text):
+    elif profile.is_in(alphabets.ASCII85):
         if text.startswith('<~') and text.endswith('~>'):
             # Adobe-style Ascii85
             try:
@@ -132,7 +148,8 @@ def try_decode_text(text):
                 yield decoded
             except ValueError:
                 _log('Not Ascii85-decodable.')
-    elif '\r' in text or '\n' in text and ' ' not in text:
+    elif profile.count('\r') > 0 \
+            or profile.count('\n') > 0 and profile.count(' ') == 0:
         _log('Newlines detected: stripping them out.')
         yield text.translate(str.maketrans('', '', '\r\n')).encode()
     else:
@@ -140,6 +157,25 @@ def try_decode_text(text):
         print(text)
 
 
+def decode_octal(text):
+    """
+    Yield the bytes of octal text: one per whitespace-separated value, or one
+    per 3 digits if the digits are all run together.
+    """
+    values = text.split()
+    if len(values) > 1 and all(len(value) <= 3 and int(value, 8) < 256
+                               for value in values):
+        yield bytes(int(value, 8) for value in values)
+        return
+    digits = ''.join(values)
+    if len(digits) % 3 == 0:
+        values = [int(''.join(value), 8) for value in grouper(digits, 3)]
+        if all(value < 256 for value in values):
+            yield bytes(values)
+            return
+    _log('Not octal-decodable.')
+
+
 def grouper(iterable, n, fillvalue=None):
     """Collect data into fixed-length chunks or blocks"""
     # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx
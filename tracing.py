@@ -0,0 +1,194 @@
+"""
+Where the time goes: spans for every decoder invocation, and for some of the
+expensive steps within them.
+
+Spans are recorded in the process that does the work, including worker
+processes, and are handed to the hooks (see add_hook) by keep_decoding, once
+it knows the depth of the blob they were about. This module has hooks that
+write spans as JSON lines or as a Chrome trace (chrome://tracing, Perfetto),
+and one that sums them up per decoder, for a profile at the end of a run.
+"""
+
+from collections import namedtuple
+import contextlib
+import json
+import os
+import time
+
+# name: decoder name, or step name for the steps within a decoder
+# start, end: wall-clock time (seconds since the epoch) the span started and
+# ended at
+# wall_s, cpu_s: time spent in the span (for a decoder invocation, only in
+# the decoder itself, not in handling what it derives as it goes)
+# bytes_in, bytes_out: size of the blob decoded, and of everything derived
+# n_children: number of blobs derived
+# depth: number of decoders that led to the blob decoded
+# error: description of the exception that ended the span, if any
+Span = namedtuple('Span', 'name pid start end wall_s cpu_s bytes_in'
+                          ' bytes_out n_children depth error')
+
+_hooks = []
+_pending = []  # Spans without a depth yet
+
+
+def add_hook(hook):
+    """Call `hook(span)` for every span from now on."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+class Invocation:
+    """
+    Measures a decoder invocation, i.e. the consumption of the blobs it
+    derives, counting only the time spent in the decoder itself.
+    """
+
+    def __init__(self, name, bytes_in):
+        self.name = name
+        self.bytes_in = bytes_in
+        self.start = None
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.bytes_out = 0
+        self.n_children = 0
+        self.error = None
+
+    def track(self, derived):
+        iterator = iter(derived)
+        while True:
+            if self.start is None:
+                self.start = time.time()
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                blob = next(iterator)
+            except StopIteration:
+                return
+            except Exception as e:
+                self.error = f'{type(e).__name__}: {e}'
+                raise
+            finally:
+                self.wall_s += time.perf_counter() - wall
+                self.cpu_s += time.process_time() - cpu
+            self.n_children += 1
+            self.bytes_out += len(blob)
+            yield blob
+
+    def finish(self):
+        end = time.time()
+        # A decoder can fail before it's consumed at all
+        start = end if self.start is None else self.start
+        _pending.append(Span(self.name, os.getpid(), start, end, self.wall_s,
+                             self.cpu_s, self.bytes_in, self.bytes_out,
+                             self.n_children, None, self.error))
+
+
+@contextlib.contextmanager
+def step(name, bytes_in=0):
+    """Record a span for the code run within, e.g. one step of a decoder."""
+    start = time.time()
+    wall, cpu = time.perf_counter(), time.process_time()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        wall_s = time.perf_counter() - wall
+        _pending.append(Span(name, os.getpid(), start, start + wall_s, wall_s,
+                             time.process_time() - cpu,
+                             bytes_in, 0, 0, None, error))
+
+
+def take():
+    """Remove and return the spans recorded in this process so far."""
+    spans = _pending[:]
+    _pending.clear()
+    return spans
+
+
+def extend(spans):
+    """Add spans recorded in another process."""
+    _pending.extend(spans)
+
+
+def flush(depth):
+    """Hand all recorded spans, about blobs at `depth`, to the hooks."""
+    for span in take():
+        span = span._replace(depth=depth)
+        for hook in _hooks:
+            hook(span)
+
+
+class JsonLinesTrace:
+    """Hook that writes every span to a file as a line of JSON."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def __call__(self, span):
+        self.file.write(json.dumps(span._asdict()) + '\n')
+
+    def close(self):
+        pass
+
+
+class ChromeTrace:
+    """
+    Hook that writes all spans to a file in the Chrome trace format, as
+    complete events from their start to their end, on a thread per depth.
+    Steps nest within the decoder invocation they were part of.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.events = []
+
+    def __call__(self, span):
+        self.events.append({
+            'name': span.name,
+            'cat': 'decoder',
+            'ph': 'X',
+            'ts': span.start * 1e6,
+            'dur': (span.end - span.start) * 1e6,
+            'pid': span.pid,
+            'tid': span.depth,
+            'args': {field: getattr(span, field)
+                     for field in ('wall_s', 'cpu_s', 'bytes_in', 'bytes_out',
+                                   'n_children', 'depth', 'error')},
+        })
+
+    def close(self):
+        json.dump({'traceEvents': self.events}, self.file)
+
+
+class Profile:
+    """Hook that sums up spans per name, to print a profile with."""
+
+    def __init__(self):
+        self.totals = {}
+
+    def __call__(self, span):
+        calls, wall_s, cpu_s, bytes_in, bytes_out, n_children, depth = \
+            self.totals.get(span.name, (0, 0.0, 0.0, 0, 0, 0, 0))
+        self.totals[span.name] = (
+            calls + 1, wall_s + span.wall_s, cpu_s + span.cpu_s,
+            bytes_in + span.bytes_in, bytes_out + span.bytes_out,
+            n_children + span.n_children, max(depth, span.depth),
+        )
+
+    def table(self):
+        """Return the profile as lines of text, the slowest first."""
+        lines = [f'{"name":<20} {"calls":>7} {"wall s":>9} {"cpu s":>9}'
+                 f' {"MB in":>9} {"MB out":>9} {"children":>9} {"depth":>6}']
+        totals = sorted(self.totals.items(), key=lambda item: -item[1][1])
+        for name, (calls, wall_s, cpu_s, bytes_in, bytes_out, n_children,
+                   depth) in totals:
+            lines.append(f'{name:<20} {calls:>7} {wall_s:>9.3f}'
+                         f' {cpu_s:>9.3f} {bytes_in / 1e6:>9.3f}'
+                         f' {bytes_out / 1e6:>9.3f} {n_children:>9}'
+                         f' {depth:>6}')
+        return lines